@@ -0,0 +1,135 @@
+# cakes/catalog_cache.py
+# Catalog metadata (categories, price range, number of cakes) kept in a small
+# file cache shared by every worker process on the host, so pages that need
+# the category list don't scan the cakes collection on each request.
+
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+class LocalCache:
+    """
+    Key -> JSON value store in a local directory, visible to all worker
+    processes on one host. Each value lives in its own file, written to a
+    temporary file and swapped in with os.replace so readers never see a
+    partial write.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def stamp(self, key):
+        """A cheap fingerprint of the key's current value (changes whenever it is rewritten)."""
+        try:
+            status = os.stat(self._path(key))
+        except OSError:
+            return None
+        return (status.st_ino, status.st_mtime_ns, status.st_size)
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as handle:
+                return json.load(handle)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        temporary = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w') as handle:
+            json.dump(value, handle)
+        os.replace(temporary, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+def load_catalog_metadata(db):
+    """Reads the categories, price range and number of cakes in one aggregation."""
+    summary = next(iter(db.cakes.aggregate([
+        {'$group': {
+            '_id': None,
+            'categories': {'$addToSet': '$category'},
+            'min_price': {'$min': '$price'},
+            'max_price': {'$max': '$price'},
+            'count': {'$sum': 1},
+        }},
+    ])), None) or {}
+    return {
+        'categories': sorted(category for category in summary.get('categories', []) if isinstance(category, str)),
+        'price_range': [summary.get('min_price'), summary.get('max_price')] if summary.get('count') else None,
+        'count': summary.get('count', 0),
+    }
+
+
+class CatalogMetadata:
+    """
+    Catalog metadata cached in a LocalCache. Writers call invalidate(), which
+    stamps the cache with a new catalog version; an entry is only used while
+    it was computed under the current version (so one computed from reads
+    made before a concurrent write is ignored) and is younger than ``ttl``,
+    which covers changes made outside the app. Each process also remembers
+    the last entry it read, so a request usually costs two stat() calls.
+    """
+    DATA_KEY = 'catalog-metadata'
+    VERSION_KEY = 'catalog-version'
+
+    def __init__(self, backend, ttl=600):
+        self.backend = backend
+        self.ttl = ttl
+        self._local = None  # (backend stamps, entry) last read by this process
+
+    def _stamps(self):
+        return (self.backend.stamp(self.VERSION_KEY), self.backend.stamp(self.DATA_KEY))
+
+    def get(self, db):
+        """Returns {'categories': [...], 'price_range': [min, max] or None, 'count': n}."""
+        stamps = self._stamps()
+        local = self._local
+        if local is not None and local[0] == stamps and local[1]['expires_at'] > time.time():
+            return local[1]['metadata']
+
+        version = self.backend.get(self.VERSION_KEY)
+        entry = self.backend.get(self.DATA_KEY)
+        if entry is not None and entry.get('version') == version and entry.get('expires_at', 0) > time.time():
+            self._local = (stamps, entry)
+            return entry['metadata']
+
+        metadata = load_catalog_metadata(db)
+        try:
+            self.backend.set(self.DATA_KEY, {
+                'version': version,
+                'expires_at': time.time() + self.ttl,
+                'metadata': metadata,
+            })
+        except OSError as e:
+            print(f"Could not write the catalog metadata cache: {e}")
+        return metadata
+
+    def invalidate(self):
+        """Marks every worker's cached metadata stale (call after adding, editing or deleting a cake)."""
+        self._local = None
+        try:
+            self.backend.set(self.VERSION_KEY, uuid.uuid4().hex)
+        except OSError as e:
+            # Fall back to dropping the entry; the TTL bounds staleness if even that fails
+            print(f"Could not update the catalog cache version: {e}")
+            try:
+                self.backend.delete(self.DATA_KEY)
+            except OSError:
+                pass
+
+
+catalog_metadata = CatalogMetadata(
+    LocalCache(os.environ.get('CATALOG_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'fyncakes-cache'))),
+    ttl=float(os.environ.get('CATALOG_CACHE_TTL', 600)),
+)
@@ -0,0 +1,74 @@
+# cakes/commands.py
+
+import click
+
+from . import db
+from .indexes import ensure_indexes, find_collection_scans, index_name
+from .order_ids import renumber_duplicate_order_ids
+from .related import rebuild_related
+from .order_consumers import rebuild_order_counters
+from .loyalty import reconcile_all_loyalty
+
+
+def backfill_student_flags():
+    """
+    Sets the denormalised 'is_student' flag on every user registered in the
+    students collection. Returns the number of student emails processed.
+    """
+    emails = [email for email in db.students.distinct('user_email') if email]
+    for email in emails:
+        db.users.update_one({'email': email}, {'$set': {'is_student': True}})
+    return len(emails)
+
+
+def register_commands(app):
+    """Registers the maintenance commands with the Flask CLI."""
+
+    @app.cli.command('backfill-student-flags')
+    def backfill_student_flags_command():
+        """One-off backfill of users.is_student from the students collection."""
+        count = backfill_student_flags()
+        click.echo(f"Marked {count} student account(s) with is_student=True")
+
+    @app.cli.command('ensure-indexes')
+    @click.option('--explain', is_flag=True, help='Report route queries that still scan whole collections.')
+    def ensure_indexes_command(explain):
+        """Creates any missing indexes the routes rely on."""
+        for collection, name, status in ensure_indexes(db):
+            click.echo(f"{collection}.{name}: {status}")
+        if explain:
+            scans = find_collection_scans(db)
+            for collection, query, sort in scans:
+                click.echo(f"COLLSCAN: {collection}.find({query})" + (f".sort({sort})" if sort else ''))
+            if not scans:
+                click.echo("Every checked route query is served by an index")
+
+    @app.cli.command('rebuild-related')
+    def rebuild_related_command():
+        """Precomputes the related-cakes recommendations shown on every cake page."""
+        count = rebuild_related(db)
+        click.echo(f"Rebuilt recommendations for {count} cake(s)")
+
+    @app.cli.command('rebuild-order-counters')
+    def rebuild_order_counters_command():
+        """Recounts the dashboard order counters from the orders collection."""
+        counters = rebuild_order_counters()
+        click.echo(f"{counters['total']} order(s), revenue Shs {counters['revenue']:,.0f}")
+
+    @app.cli.command('reconcile-loyalty')
+    def reconcile_loyalty_command():
+        """Recounts every customer's loyalty balance from their orders, logging adjustments in the ledger."""
+        count = reconcile_all_loyalty()
+        click.echo(f"Reconciled loyalty points for {count} customer(s)")
+
+    @app.cli.command('dedupe-order-ids')
+    def dedupe_order_ids_command():
+        """Renumbers orders that share a legacy order ID, then creates the unique order_id index."""
+        renumbered = renumber_duplicate_order_ids()
+        for old_id, new_id in renumbered:
+            click.echo(f"{old_id} -> {new_id}")
+        click.echo(f"Renumbered {len(renumbered)} order(s)")
+        name = index_name([('order_id', 1)])
+        for collection, index, status in ensure_indexes(db):
+            if collection == 'orders' and index == name:
+                click.echo(f"orders.{index}: {status}")
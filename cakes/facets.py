@@ -0,0 +1,129 @@
+# cakes/facets.py
+# Catalog listing facets: per-category counts, a price-band histogram and the
+# first page of cakes, all from one $facet aggregation and cached per
+# (category, search) combination, so a listing view costs at most one query.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .pagination import next_page_cursor, page_sort
+from .search import TEXT_SCORE, catalog_query
+
+# Lower bounds of the price bands (Shs), matching the catalog's price dropdown;
+# the last band is open-ended
+PRICE_BANDS = [0, 50000, 100000, 200000]
+
+
+def facet_pipeline(category, search_query, sort, limit):
+    """
+    The aggregation behind a listing. Category counts cover everything that
+    matches the search, so the other categories stay visible (with their
+    counts) once one is selected; the price bands, total and results are
+    narrowed to the selected category as well.
+    """
+    selected = {'category': category} if category else {}
+    if search_query:
+        # Best matches first, as keyset_page orders search results
+        order = {'score': TEXT_SCORE, **dict(sort)}
+    else:
+        order = dict(sort)
+    return [
+        {'$match': catalog_query(None, search_query)},
+        {'$facet': {
+            'categories': [
+                {'$group': {'_id': '$category', 'count': {'$sum': 1}}},
+                {'$sort': {'_id': 1}},
+            ],
+            'price_bands': [
+                {'$match': selected},
+                {'$bucket': {
+                    'groupBy': '$price',
+                    'boundaries': PRICE_BANDS + [float('inf')],
+                    'default': 'unpriced',
+                }},
+            ],
+            'total': [
+                {'$match': selected},
+                {'$count': 'count'},
+            ],
+            'results': [
+                {'$match': selected},
+                {'$sort': order},
+                {'$limit': limit + 1},
+            ],
+        }},
+    ]
+
+
+class CatalogFacets:
+    """
+    Size-bounded LRU cache of listing facets with a short TTL. Like the user
+    cache, each worker has its own copy: the admin views call invalidate()
+    when a cake changes, and the TTL bounds how long other workers can show
+    stale counts. Cached listings are shared, so callers must not modify them.
+    """
+    def __init__(self, ttl=60, max_size=256):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def _fetch(self, db, category, search_query, sort, limit):
+        sort = page_sort(sort)
+        pipeline = facet_pipeline(category, search_query, sort, limit)
+        facets = next(iter(db.cakes.aggregate(pipeline)), None) or {}
+        results = list(facets.get('results', []))
+        total = facets.get('total') or [{'count': 0}]
+        price_bands = {band: 0 for band in PRICE_BANDS}
+        for bucket in facets.get('price_bands', []):
+            if bucket['_id'] in price_bands:
+                price_bands[bucket['_id']] = bucket['count']
+        categories = [(bucket['_id'], bucket['count']) for bucket in facets.get('categories', [])
+                      if bucket['_id'] is not None]
+        if category and category not in dict(categories):
+            categories = sorted(categories + [(category, 0)])
+        return {
+            'cakes': results[:limit],
+            'next_cursor': next_page_cursor(catalog_query(category, search_query), sort, results, limit),
+            'total': total[0]['count'],
+            'categories': categories,
+            'price_bands': price_bands,
+        }
+
+    def get(self, db, category=None, search_query='', sort=(('_id', 1),), limit=6):
+        """
+        Returns the listing for a filter combination as a dict with 'cakes'
+        (the first page), 'next_cursor', 'total', 'categories' ([(name,
+        count)]) and 'price_bands' ({lower bound: count}).
+        """
+        key = (category or None, search_query, tuple(sort), limit)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] >= time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[0]
+            generation = self._generation
+        listing = self._fetch(db, category, search_query, sort, limit)
+        with self._lock:
+            # Don't cache a listing read before a concurrent invalidate()
+            if generation == self._generation:
+                self._entries[key] = (listing, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return listing
+
+    def invalidate(self):
+        """Drops every cached listing (call after adding, editing or deleting a cake)."""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+catalog_facets = CatalogFacets(
+    ttl=float(os.environ.get('CATALOG_FACETS_TTL', 60)),
+    max_size=int(os.environ.get('CATALOG_FACETS_SIZE', 256)),
+)
@@ -0,0 +1,140 @@
+# cakes/idempotency.py
+# Idempotency keys for the write endpoints (order placement, cart and
+# wishlist changes). The browser sends an Idempotency-Key header with each
+# write and reuses it when it retries; the first request's response is kept
+# in the idempotency_keys collection and replayed for any repeat, so a
+# double click or a retry after a dropped connection never writes twice.
+
+import functools
+import hashlib
+import os
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app, jsonify, make_response, request
+from flask_login import current_user
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    from .mock_db import DuplicateKeyError
+
+from . import db
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 128
+
+
+class IdempotencyKeys:
+    """
+    Stores one record per (user, endpoint, key). The first request inserts
+    it as 'in_progress' (the unique _id makes that a lock), runs the view and
+    saves the response; a repeat with the same key replays that response, or
+    waits up to ``wait`` seconds while the first is still running. A request
+    that fails (status 400 or above, or an exception) releases its key, since
+    it wrote nothing, so the client can retry with the same key. Records
+    expire after ``ttl`` seconds (TTL index on expires_at).
+    """
+    def __init__(self, ttl=24 * 3600, lock_timeout=60, wait=5.0, poll_interval=0.1):
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    def _fingerprint(self):
+        digest = hashlib.sha256()
+        digest.update(f"{request.method} {request.path}\n".encode())
+        digest.update(request.get_data())
+        return digest.hexdigest()
+
+    def _lock(self, record_id, fingerprint):
+        """Claims the key. Returns None when this request should run the view, else the response to send."""
+        deadline = time.monotonic() + self.wait
+        while True:
+            now = datetime.now()
+            try:
+                db.idempotency_keys.insert_one({
+                    '_id': record_id,
+                    'fingerprint': fingerprint,
+                    'state': 'in_progress',
+                    'locked_until': now + timedelta(seconds=self.lock_timeout),
+                    'created_at': now,
+                    'expires_at': now + timedelta(seconds=self.ttl),
+                })
+                return None
+            except DuplicateKeyError:
+                record = db.idempotency_keys.find_one({'_id': record_id})
+            if record is None:
+                continue  # Released by a failed request in the meantime
+            if record.get('fingerprint') != fingerprint:
+                return jsonify({'success': False,
+                                'message': 'This Idempotency-Key was already used for a different request.'}), 422
+            if record['state'] == 'completed':
+                return self._replay(record['response'])
+            if record['locked_until'] < now:
+                # The request holding the key died; take it over
+                result = db.idempotency_keys.update_one(
+                    {'_id': record_id, 'state': 'in_progress', 'locked_until': record['locked_until']},
+                    {'$set': {'locked_until': now + timedelta(seconds=self.lock_timeout)}},
+                )
+                if result.modified_count:
+                    return None
+            if time.monotonic() >= deadline:
+                response = jsonify({'success': False, 'message': 'This request is still being processed.'})
+                response.status_code = 409
+                response.headers['Retry-After'] = '1'
+                return response
+            time.sleep(self.poll_interval)
+
+    def _replay(self, stored):
+        response = current_app.response_class(stored['body'], status=stored['status'], mimetype=stored['mimetype'])
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    def idempotent(self, view):
+        """
+        View decorator (put it below @login_required). Requests without an
+        Idempotency-Key header run as before.
+        """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return jsonify({'success': False, 'message': f'{HEADER} is too long.'}), 400
+
+            user = current_user.email if current_user.is_authenticated else request.remote_addr
+            record_id = f"{user}:{request.endpoint}:{key}"
+            locked = self._lock(record_id, self._fingerprint())
+            if locked is not None:
+                return locked
+
+            try:
+                response = make_response(view(*args, **kwargs))
+            except Exception:
+                db.idempotency_keys.delete_one({'_id': record_id, 'state': 'in_progress'})
+                raise
+            if response.status_code >= 400:
+                db.idempotency_keys.delete_one({'_id': record_id, 'state': 'in_progress'})
+                return response
+            db.idempotency_keys.update_one(
+                {'_id': record_id},
+                {'$set': {
+                    'state': 'completed',
+                    'completed_at': datetime.now(),
+                    'response': {
+                        'status': response.status_code,
+                        'mimetype': response.mimetype,
+                        'body': response.get_data(as_text=True),
+                    },
+                }, '$unset': {'locked_until': ''}},
+            )
+            return response
+        return wrapper
+
+
+idempotency_keys = IdempotencyKeys(
+    ttl=int(os.environ.get('IDEMPOTENCY_KEY_TTL', 24 * 3600)),
+)
+idempotent = idempotency_keys.idempotent
@@ -0,0 +1,117 @@
+# cakes/indexes.py
+# Index declarations for every query shape the routes run, shared by MongoDB
+# (`flask ensure-indexes` and the startup hook) and the mock database.
+
+# (collection, keys, options)
+INDEXES = [
+    ('users', [('email', 1)], {'unique': True}),
+    ('users', [('username', 1)], {}),
+    ('users', [('role', 1)], {}),
+    ('unverified_users', [('email', 1)], {'unique': True}),
+    # TTL: MongoDB deletes pending signups once expires_at has passed
+    ('unverified_users', [('expires_at', 1)], {'expireAfterSeconds': 0}),
+    ('carts', [('user_email', 1)], {}),
+    ('wishlist', [('user_email', 1), ('cake_id', 1)], {}),
+    ('orders', [('customer_email', 1), ('created_at', -1)], {}),
+    ('orders', [('status', 1)], {}),
+    ('orders', [('created_at', -1)], {}),
+    # Human order IDs (FYN-1000001); sparse because older orders may not have one
+    ('orders', [('order_id', 1)], {'unique': True, 'sparse': True}),
+    ('comments', [('approved', 1), ('created_at', -1)], {}),
+    ('comments', [('cake_id', 1)], {}),
+    ('cakes', [('category', 1)], {}),
+    # Catalog search ($text); a collection can have only one text index
+    ('cakes', [('name', 'text'), ('description', 'text'), ('category', 'text'), ('ingredients', 'text')],
+     {'weights': {'name': 10, 'category': 5, 'ingredients': 3, 'description': 1}}),
+    ('students', [('user_email', 1)], {}),
+    ('loyalty_points', [('customer_email', 1)], {'unique': True}),
+    ('loyalty_ledger', [('customer_email', 1), ('created_at', -1)], {}),
+    # Order events: orders with events still to relay, and the processors' due-event scan
+    ('orders', [('has_pending_events', 1)], {'sparse': True}),
+    ('order_events', [('state', 1), ('next_attempt_at', 1)], {}),
+    ('order_event_receipts', [('created_at', 1)], {'expireAfterSeconds': 90 * 24 * 3600}),
+    # Tombstones of deleted orders for the recounts, dropped after 30 days
+    ('deleted_orders', [('customer_email', 1), ('at', 1)], {}),
+    ('deleted_orders', [('at', 1)], {'expireAfterSeconds': 30 * 24 * 3600}),
+    # Email outbox: the senders' due-message scan, and TTL cleanup of sent mail after 30 days
+    ('email_outbox', [('status', 1), ('next_attempt_at', 1)], {}),
+    ('email_outbox', [('sent_at', 1)], {'expireAfterSeconds': 30 * 24 * 3600}),
+    # TTL: stored responses for idempotency keys are dropped once expires_at has passed
+    ('idempotency_keys', [('expires_at', 1)], {'expireAfterSeconds': 0}),
+]
+
+# Representative filters (and sorts) of the hot route queries, checked with
+# explain() by `flask ensure-indexes --explain`
+ROUTE_QUERIES = [
+    ('users', {'email': 'customer@example.com'}, None),
+    ('users', {'username': 'customer'}, None),
+    ('users', {'role': 'customer'}, [('_id', -1)]),
+    ('unverified_users', {'email': 'customer@example.com'}, None),
+    ('carts', {'user_email': 'customer@example.com'}, None),
+    ('carts', {'user_email': 'customer@example.com', 'name': 'Chocolate Delight'}, None),
+    ('wishlist', {'user_email': 'customer@example.com'}, [('added_at', -1)]),
+    ('wishlist', {'user_email': 'customer@example.com', 'cake_id': 'cake_1'}, None),
+    ('orders', {'customer_email': 'customer@example.com'}, [('created_at', -1)]),
+    ('orders', {'status': 'pending'}, None),
+    ('orders', {'order_id': 'FYN-1000001', 'customer_email': 'customer@example.com'}, None),
+    ('comments', {'approved': True}, [('created_at', -1)]),
+    ('comments', {'cake_id': 'cake_1'}, [('_id', -1)]),
+    ('cakes', {'category': 'Wedding Cake'}, None),
+    ('cakes', {'$text': {'$search': 'chocolate'}}, None),
+    ('students', {'user_email': 'customer@example.com'}, None),
+    ('loyalty_points', {'customer_email': 'customer@example.com'}, None),
+    ('loyalty_ledger', {'customer_email': 'customer@example.com'}, [('created_at', -1)]),
+    ('email_outbox', {'status': 'pending'}, [('created_at', 1)]),
+    ('orders', {'has_pending_events': True}, None),
+]
+
+
+def index_name(keys):
+    """The name MongoDB gives an index by default, e.g. 'customer_email_1_created_at_-1'."""
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+
+def ensure_indexes(db):
+    """
+    Creates every declared index that doesn't exist yet. Safe to run on every
+    start: existing indexes are left alone. Returns a list of
+    (collection, index name, status) tuples, status being 'created',
+    'exists' or the error that prevented creating the index.
+    """
+    results = []
+    existing = {}
+    for collection, keys, options in INDEXES:
+        name = index_name(keys)
+        try:
+            if collection not in existing:
+                existing[collection] = set(db[collection].index_information())
+            if name in existing[collection]:
+                results.append((collection, name, 'exists'))
+                continue
+            db[collection].create_index(keys, name=name, **options)
+            existing[collection].add(name)
+            results.append((collection, name, 'created'))
+        except Exception as e:
+            # e.g. duplicate emails blocking a unique index; keep going with the rest
+            results.append((collection, name, f"failed: {e}"))
+    return results
+
+
+def _plan_stages(plan):
+    yield plan.get('stage')
+    for child in [plan.get('inputStage')] + list(plan.get('inputStages', [])):
+        if child:
+            yield from _plan_stages(child)
+
+
+def find_collection_scans(db):
+    """Returns the ROUTE_QUERIES whose winning plan still scans the whole collection."""
+    scans = []
+    for collection, query, sort in ROUTE_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+        if 'COLLSCAN' in _plan_stages(plan):
+            scans.append((collection, query, sort))
+    return scans
@@ -0,0 +1,205 @@
+# cakes/loyalty.py
+# Customer loyalty points, earned from orders.
+#
+# Each customer's balance (loyalty_points) keeps running totals of the orders
+# that earn points and is updated incrementally from the order events: an
+# order earns when it is placed and the points are reversed if it is
+# cancelled or deleted. Every change is written to the loyalty_ledger, and
+# reconcile_loyalty() recounts a balance from the orders when it drifts
+# (`flask reconcile-loyalty` does every customer), so the dashboard only
+# ever reads one small document.
+
+import uuid
+from datetime import datetime
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    from .mock_db import DuplicateKeyError
+
+from . import db
+from .order_events import covers, recount_coverage
+
+
+def points_for(total_orders, total_spent):
+    """The points earned by ``total_orders`` orders worth ``total_spent`` shillings."""
+    # Points for orders (10 points per order)
+    points = total_orders * 10
+
+    # Points for spending (1 point per 1000 shillings)
+    points += int(total_spent / 1000)
+
+    # Bonus points for milestones
+    if total_orders >= 5:
+        points += 50  # 5+ orders bonus
+    if total_orders >= 10:
+        points += 100  # 10+ orders bonus
+    if total_spent >= 500000:  # 500k shillings
+        points += 200  # Big spender bonus
+    return points
+
+
+# --- Reconciliation ----------------------------------------------------------
+
+def _read_orders(customer_email):
+    """
+    Returns (total_orders, total_spent, covered) for the customer's orders
+    (cancelled ones don't earn). ``covered`` is what the read counted, as
+    order id -> time of the last change included (see recount_coverage).
+    """
+    total_orders, total_spent, seen = 0, 0, {}
+    orders = db.orders.find({'customer_email': customer_email, 'sample': {'$ne': True}},
+                            {'status': 1, 'total_amount': 1, 'last_event_at': 1})
+    for order in orders:
+        seen[str(order['_id'])] = order.get('last_event_at')
+        if order.get('status') != 'cancelled':
+            total_orders += 1
+            total_spent += order.get('total_amount') or 0
+    return total_orders, total_spent, recount_coverage(seen, {'customer_email': customer_email})
+
+def reconcile_loyalty(customer_email, attempts=5):
+    """
+    Recounts the customer's balance from their orders and records any
+    difference in the ledger as an adjustment. The balance remembers which
+    order changes the recount saw (reconciled_orders), so their events are
+    skipped afterwards while later ones still apply. The balance is only
+    replaced if no event changed it while the orders were being read;
+    otherwise the recount starts over. Returns the points.
+    """
+    for _ in range(attempts):
+        balance = db.loyalty_points.find_one({'customer_email': customer_email})
+        total_orders, total_spent, covered = _read_orders(customer_email)
+        now = datetime.now()
+        fields = {
+            'points': points_for(total_orders, total_spent),
+            'total_orders': total_orders,
+            'total_spent': total_spent,
+            'reconciled_orders': covered,
+            'reconciled_at': now,
+            'last_updated': now,
+        }
+        if balance is None:
+            balance = {}
+            try:
+                db.loyalty_points.insert_one({'customer_email': customer_email, **fields,
+                                              'revision': 0, 'created_at': now})
+            except DuplicateKeyError:
+                continue
+        else:
+            result = db.loyalty_points.update_one(
+                {'_id': balance['_id'], 'revision': balance.get('revision')},
+                {'$set': fields, '$inc': {'revision': 1}},
+            )
+            if not result.modified_count:
+                continue
+
+        adjustment = {
+            'orders': total_orders - (balance.get('total_orders') or 0),
+            'spent': total_spent - (balance.get('total_spent') or 0),
+            'points': fields['points'] - (balance.get('points') or 0),
+        }
+        if any(adjustment.values()):
+            db.loyalty_ledger.insert_one({'_id': uuid.uuid4().hex, 'customer_email': customer_email,
+                                          'kind': 'adjustment', **adjustment, 'created_at': now})
+        return fields['points']
+    raise RuntimeError(f"Loyalty balance of {customer_email} kept changing during reconciliation")
+
+def reconcile_all_loyalty():
+    """Reconciles every customer with orders or a balance. Returns the number of customers."""
+    emails = {email for email in db.orders.distinct('customer_email') if email}
+    emails |= {email for email in db.loyalty_points.distinct('customer_email') if email}
+    for email in emails:
+        reconcile_loyalty(email)
+    return len(emails)
+
+
+# --- Incremental updates -----------------------------------------------------
+
+def _earnings(event):
+    """What an order event does to the balance: (orders, spent), both 0 if nothing."""
+    amount = event.get('total_amount') or 0
+    if event['type'] == 'order_created' and event.get('status') != 'cancelled':
+        return 1, amount
+    if event['type'] == 'order_cancelled' and event.get('previous_status') != 'cancelled':
+        return -1, -amount
+    if event['type'] == 'order_status_changed' and event.get('previous_status') == 'cancelled':
+        return 1, amount  # Reinstated
+    if event['type'] == 'order_deleted' and event.get('status') != 'cancelled':
+        return -1, -amount
+    return 0, 0
+
+def apply_order_event(event, attempts=5):
+    """
+    Applies an order event to the customer's balance and writes the ledger
+    entry. The entry is keyed by the event and written first, so a
+    redelivered event is not applied twice (a crash in between loses that
+    one update, which the next reconciliation restores). The totals and
+    points are replaced together, only if the balance's revision is still
+    the one read; when it isn't, the balance is read again, and the event
+    is dropped if a reconciliation has counted it in the meantime.
+    """
+    customer_email = event.get('customer_email')
+    orders, spent = _earnings(event)
+    if not customer_email or not (orders or spent):
+        return
+    recorded = False
+    for _ in range(attempts):
+        balance = db.loyalty_points.find_one({'customer_email': customer_email})
+        if balance is None or 'reconciled_orders' not in balance:
+            # No balance yet (or one from the old full recount): building it
+            # from the orders counts this change
+            reconcile_loyalty(customer_email)
+            break
+        if covers(balance['reconciled_orders'], event):
+            break  # The last reconciliation read the order after this change
+
+        if not recorded:
+            try:
+                db.loyalty_ledger.insert_one({
+                    '_id': event['_id'],
+                    'customer_email': customer_email,
+                    'order_id': event.get('order_id'),
+                    'kind': 'earn' if orders > 0 else 'reversal',
+                    'orders': orders,
+                    'spent': spent,
+                    'created_at': datetime.now(),
+                })
+            except DuplicateKeyError:
+                return
+            recorded = True
+
+        total_orders = (balance.get('total_orders') or 0) + orders
+        total_spent = (balance.get('total_spent') or 0) + spent
+        points = points_for(total_orders, total_spent)
+        result = db.loyalty_points.update_one(
+            {'_id': balance['_id'], 'revision': balance.get('revision')},
+            {'$set': {'total_orders': total_orders, 'total_spent': total_spent, 'points': points,
+                      'last_updated': datetime.now()},
+             '$inc': {'revision': 1}},
+        )
+        if result.modified_count:
+            db.loyalty_ledger.update_one({'_id': event['_id']},
+                                         {'$set': {'points': points - (balance.get('points') or 0)}})
+            return
+    else:
+        if recorded:
+            # Let the retry record and apply it
+            db.loyalty_ledger.delete_one({'_id': event['_id']})
+        raise RuntimeError(f"Loyalty balance of {customer_email} kept changing")
+    if recorded:
+        # A reconciliation counted the change before we could apply it
+        db.loyalty_ledger.delete_one({'_id': event['_id']})
+
+
+# --- Reading -----------------------------------------------------------------
+
+def get_loyalty_points(customer_email):
+    """The customer's points: one read of their balance (built from the orders the first time)."""
+    try:
+        balance = db.loyalty_points.find_one({'customer_email': customer_email}, {'reconciled_orders': 0})
+        if balance is None or 'reconciled_at' not in balance:
+            return reconcile_loyalty(customer_email)
+        return balance.get('points', 0)
+    except Exception as e:
+        print(f"Error reading loyalty points: {e}")
+        return 0
@@ -1,111 +1,1796 @@
 # Mock Database for Development (No MongoDB Required)
 # This allows the application to run without MongoDB for testing
 
+import bisect
+import contextlib
+import copy
+import functools
+import heapq
+import itertools
+import re
+import threading
 from datetime import datetime, timedelta
 
+from .indexes import ensure_indexes
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    # Mock DuplicateKeyError for development without pymongo
+    class DuplicateKeyError(Exception):
+        pass
+
+try:
+    from pymongo import DeleteMany, DeleteOne, InsertOne, UpdateMany, UpdateOne
+except ImportError:
+    # Mock bulk_write request types; same attribute names as pymongo's
+    class InsertOne:
+        def __init__(self, document):
+            self._doc = document
+
+    class _UpdateRequest:
+        def __init__(self, filter, update, upsert=False):
+            self._filter = filter
+            self._doc = update
+            self._upsert = upsert
+
+    class UpdateOne(_UpdateRequest):
+        pass
+
+    class UpdateMany(_UpdateRequest):
+        pass
+
+    class _DeleteRequest:
+        def __init__(self, filter):
+            self._filter = filter
+
+    class DeleteOne(_DeleteRequest):
+        pass
+
+    class DeleteMany(_DeleteRequest):
+        pass
+
+RANGE_OPERATORS = ('$gt', '$gte', '$lt', '$lte')
+TEXT_SCORE = {'$meta': 'textScore'}
+
+
+def _get_field(document, path):
+    """Resolves a (possibly dotted) field path, returning None when absent."""
+    if '.' not in path:
+        return document.get(path) if isinstance(document, dict) else None
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def _hashable(value):
+    """Converts a field value into something usable as a dict key."""
+    if isinstance(value, dict):
+        return tuple((k, _hashable(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+def _bracket(value):
+    """Ranks a value's type the way MongoDB orders BSON types."""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 6
+    if isinstance(value, (int, float)):
+        return 1
+    if isinstance(value, str):
+        return 2
+    if isinstance(value, dict):
+        return 3
+    if isinstance(value, (list, tuple)):
+        return 4
+    if isinstance(value, datetime):
+        return 7
+    return 5
+
+def _sort_key(value):
+    """Orders values of mixed types roughly the way MongoDB compares BSON types."""
+    bracket = _bracket(value)
+    if bracket == 0:
+        return (0, 0)
+    if bracket == 3:
+        return (3, str(sorted(value.items(), key=str)))
+    if bracket == 4:
+        return (4, [_sort_key(v) for v in value])
+    if bracket == 5:
+        return (5, str(value))
+    return (bracket, value)
+
+class _SortKey:
+    """Comparable wrapper applying a multi-field sort spec with mixed directions."""
+    __slots__ = ('values', 'directions')
+    
+    def __init__(self, document, spec):
+        self.values = [_sort_key(_get_field(document, field)) for field, _ in spec]
+        self.directions = [direction for _, direction in spec]
+    
+    def __lt__(self, other):
+        for mine, theirs, direction in zip(self.values, other.values, self.directions):
+            if mine != theirs:
+                return mine < theirs if direction > 0 else mine > theirs
+        return False
+
+def _sort_documents(documents, spec, wanted=None):
+    """
+    Orders documents by a list of (field, direction) pairs. When only the
+    first ``wanted`` documents are needed they are selected with a heap
+    (O(N log K)) instead of sorting everything.
+    """
+    if len(spec) == 1:
+        field, direction = spec[0]
+        key = lambda document: _sort_key(_get_field(document, field))
+        if wanted is not None:
+            select = heapq.nsmallest if direction > 0 else heapq.nlargest
+            return select(wanted, documents, key=key)
+        return sorted(documents, key=key, reverse=direction < 0)
+    key = lambda document: _SortKey(document, spec)
+    if wanted is not None:
+        return heapq.nsmallest(wanted, documents, key=key)
+    return sorted(documents, key=key)
+
+
+# =============================================================================
+# QUERY COMPILER
+# =============================================================================
+# A filter dict is compiled once into a predicate over documents instead of
+# being re-interpreted for every document. Plans are cached by query *shape*
+# (field names and operators, not values), so repeated queries such as
+# {'email': ...} with different emails reuse the same plan and only bind
+# their values (compiling any $regex once per query).
+
+def _field_getter(field):
+    if '.' in field:
+        return lambda document: _get_field(document, field)
+    return lambda document: document.get(field)
+
+def _has_field(document, path):
+    value = document
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return False
+        value = value[part]
+    return True
+
+# Like MongoDB, a test against an array field matches if it holds for the
+# array as a whole or for any of its elements ({'tags': 'vegan'} finds
+# tags: ['vegan', 'nut-free']); $ne and $nin match only if no element does.
+
+def _elementwise(test):
+    def matches(value):
+        if isinstance(value, list):
+            return test(value) or any(test(element) for element in value)
+        return test(value)
+    return matches
+
+def _equals(operand):
+    return lambda value: value == operand or (isinstance(value, list) and operand in value)
+
+def _member_of(operand):
+    def matches(value):
+        if value in operand:
+            return True
+        return isinstance(value, list) and any(element in operand for element in value)
+    return matches
+
+def _negate(test):
+    return lambda value: not test(value)
+
+def _comparison(check):
+    def build(bound, condition):
+        bracket = _bracket(bound)
+        return _elementwise(lambda value: value is not None and _bracket(value) == bracket and check(value, bound))
+    return build
+
+_REGEX_FLAGS = {'i': re.IGNORECASE, 'm': re.MULTILINE, 's': re.DOTALL, 'x': re.VERBOSE}
+
+def _regex(pattern, condition):
+    flags = 0
+    for option in condition.get('$options', ''):
+        flags |= _REGEX_FLAGS.get(option, 0)
+    search = (pattern if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)).search
+    test = lambda value: search('' if value is None else str(value)) is not None
+    # Only the elements of an array are matched, not its printed form
+    return lambda value: any(test(element) for element in value) if isinstance(value, list) else test(value)
+
+# Operator dispatch table: operator -> builder(operand, condition) -> test(field_value)
+QUERY_OPERATORS = {
+    '$eq': lambda operand, condition: _equals(operand),
+    '$ne': lambda operand, condition: _negate(_equals(operand)),
+    '$gt': _comparison(lambda value, bound: value > bound),
+    '$gte': _comparison(lambda value, bound: value >= bound),
+    '$lt': _comparison(lambda value, bound: value < bound),
+    '$lte': _comparison(lambda value, bound: value <= bound),
+    '$in': lambda operand, condition: _member_of(operand),
+    '$nin': lambda operand, condition: _negate(_member_of(operand)),
+    '$regex': _regex,
+}
+
+# Operators that modify another operator rather than testing on their own
+_MODIFIER_OPERATORS = ('$options',)
+
+LOGICAL_OPERATORS = ('$and', '$or', '$nor')
+
+def _query_shape(query):
+    """Describes a filter's structure (fields and operators) without its values."""
+    shape = []
+    for field, condition in query.items():
+        if field in LOGICAL_OPERATORS:
+            shape.append((field, tuple(_query_shape(clause) for clause in condition)))
+        elif field == '$text':
+            shape.append((field, None))
+        elif field.startswith('$'):
+            raise ValueError(f"unknown top level operator: {field}")
+        elif isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            shape.append((field, tuple(sorted(condition))))
+        else:
+            shape.append((field, None))
+    return tuple(shape)
+
+def _bind_equality(field):
+    get = _field_getter(field)
+    def bind(value):
+        def predicate(document):
+            found = get(document)
+            return found == value or (isinstance(found, list) and value in found)
+        return predicate
+    return bind
+
+def _bind_operators(field, operators):
+    get = _field_getter(field)
+    for operator in operators:
+        if operator not in QUERY_OPERATORS and operator not in _MODIFIER_OPERATORS and operator != '$exists':
+            raise ValueError(f"unknown operator: {operator}")
+    
+    def bind(condition):
+        tests = [QUERY_OPERATORS[op](condition[op], condition) for op in operators if op in QUERY_OPERATORS]
+        exists = condition.get('$exists')
+        if exists is None and len(tests) == 1:
+            test = tests[0]
+            return lambda document: test(get(document))
+        
+        def predicate(document):
+            if exists is not None and _has_field(document, field) != bool(exists):
+                return False
+            value = get(document)
+            for test in tests:
+                if not test(value):
+                    return False
+            return True
+        return predicate
+    return bind
+
+def _bind_logical(operator):
+    def bind(clauses):
+        predicates = [compile_query(clause) for clause in clauses]
+        if operator == '$and':
+            return lambda document: all(predicate(document) for predicate in predicates)
+        if operator == '$or':
+            return lambda document: any(predicate(document) for predicate in predicates)
+        return lambda document: not any(predicate(document) for predicate in predicates)
+    return bind
+
+@functools.lru_cache(maxsize=256)
+def _plan_for_shape(shape):
+    """Builds (and caches) a binder turning a query of this shape into a predicate."""
+    binders = []
+    for field, operators in shape:
+        if field in LOGICAL_OPERATORS:
+            binders.append(_bind_logical(field))
+        elif field == '$text':
+            # Matching is done up front by the collection's text index (see _plan)
+            binders.append(lambda condition: _match_all)
+        elif operators is None:
+            binders.append(_bind_equality(field))
+        else:
+            binders.append(_bind_operators(field, operators))
+    
+    def bind(query):
+        tests = [binder(condition) for binder, condition in zip(binders, query.values())]
+        if len(tests) == 1:
+            return tests[0]
+        
+        def predicate(document):
+            for test in tests:
+                if not test(document):
+                    return False
+            return True
+        return predicate
+    return bind
+
+def _match_all(document):
+    return True
+
+def compile_query(query):
+    """Compiles a MongoDB-style filter dict into a predicate over documents."""
+    if not query:
+        return _match_all
+    return _plan_for_shape(_query_shape(query))(query)
+
+
+# =============================================================================
+# AGGREGATION PIPELINE
+# =============================================================================
+# Pipelines run as a chain of generators, one per stage, so streaming stages
+# ($match, $project, $addFields, $lookup, $unwind, $skip, $limit) never hold
+# more than the current document. $group, $sort and $facet are blocking by
+# nature; a $sort directly followed by $limit keeps only the top K documents.
+
+def _set_field(document, path, value):
+    # Stages work on shallow copies of stored documents, so each nested dict
+    # on the path is copied before it is written to
+    parts = path.split('.')
+    for part in parts[:-1]:
+        child = document.get(part)
+        document[part] = dict(child) if isinstance(child, dict) else {}
+        document = document[part]
+    document[parts[-1]] = value
+
+def _unset_field(document, path):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.get(part)
+        if not isinstance(document, dict):
+            return
+    document.pop(parts[-1], None)
+
+def _arguments(args, document):
+    if isinstance(args, list):
+        return [_evaluate(arg, document) for arg in args]
+    return [_evaluate(args, document)]
+
+def _numbers(values):
+    return [value for value in values if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+def _expr_sum(args, document):
+    values = _arguments(args, document)
+    if len(values) == 1 and isinstance(values[0], list):
+        values = values[0]
+    return sum(_numbers(values))
+
+def _expr_subtract(args, document):
+    left, right = _arguments(args, document)
+    if left is None or right is None:
+        return None
+    return left - right
+
+def _expr_multiply(args, document):
+    result = 1
+    for value in _arguments(args, document):
+        if value is None:
+            return None
+        result *= value
+    return result
+
+def _expr_divide(args, document):
+    left, right = _arguments(args, document)
+    if left is None or right is None:
+        return None
+    return left / right
+
+def _expr_compare(check):
+    def evaluate(args, document):
+        left, right = _arguments(args, document)
+        return check(_sort_key(left), _sort_key(right))
+    return evaluate
+
+def _expr_size(args, document):
+    value = _arguments(args, document)[0]
+    if not isinstance(value, list):
+        raise ValueError("The argument to $size must be an array")
+    return len(value)
+
+def _expr_cond(args, document):
+    if isinstance(args, dict):
+        args = [args['if'], args['then'], args['else']]
+    condition, then, otherwise = args
+    return _evaluate(then if _evaluate(condition, document) else otherwise, document)
+
+def _expr_if_null(args, document):
+    for value in _arguments(args, document):
+        if value is not None:
+            return value
+    return None
+
+def _expr_concat(args, document):
+    values = _arguments(args, document)
+    if any(value is None for value in values):
+        return None
+    return ''.join(values)
+
+def _expr_array_elem_at(args, document):
+    array, position = _arguments(args, document)
+    try:
+        return array[position]
+    except (IndexError, TypeError):
+        return None
+
+def _expr_date_to_string(args, document):
+    date = _evaluate(args['date'], document)
+    if not isinstance(date, datetime):
+        return None
+    return date.strftime(args.get('format', '%Y-%m-%dT%H:%M:%S.%LZ').replace('%L', '000'))
+
+class _Scored(dict):
+    """A document matched by a leading $text stage, carrying its relevance for {'$meta': 'textScore'}."""
+    __slots__ = ('text_score',)
+    
+    def __init__(self, document, text_score):
+        super().__init__(document)
+        self.text_score = text_score
+
+def _expr_meta(args, document):
+    if args != 'textScore':
+        raise ValueError(f"Unsupported $meta keyword: {args}")
+    # Only documents straight from a $text match are scored; reshaping
+    # stages ($project, $group, ...) produce plain documents
+    return getattr(document, 'text_score', None)
+
+# Expression operator dispatch table: operator -> evaluate(args, document)
+EXPRESSION_OPERATORS = {
+    '$add': lambda args, document: _expr_sum(args, document),
+    '$sum': _expr_sum,
+    '$subtract': _expr_subtract,
+    '$multiply': _expr_multiply,
+    '$divide': _expr_divide,
+    '$eq': _expr_compare(lambda left, right: left == right),
+    '$ne': _expr_compare(lambda left, right: left != right),
+    '$gt': _expr_compare(lambda left, right: left > right),
+    '$gte': _expr_compare(lambda left, right: left >= right),
+    '$lt': _expr_compare(lambda left, right: left < right),
+    '$lte': _expr_compare(lambda left, right: left <= right),
+    '$and': lambda args, document: all(_arguments(args, document)),
+    '$or': lambda args, document: any(_arguments(args, document)),
+    '$not': lambda args, document: not _arguments(args, document)[0],
+    '$in': lambda args, document: (lambda value, array: value in (array or []))(*_arguments(args, document)),
+    '$size': _expr_size,
+    '$cond': _expr_cond,
+    '$ifNull': _expr_if_null,
+    '$concat': _expr_concat,
+    '$toString': lambda args, document: (lambda value: None if value is None else str(value))(*_arguments(args, document)),
+    '$toLower': lambda args, document: str(_arguments(args, document)[0] or '').lower(),
+    '$toUpper': lambda args, document: str(_arguments(args, document)[0] or '').upper(),
+    '$arrayElemAt': _expr_array_elem_at,
+    '$literal': lambda args, document: args,
+    '$dateToString': _expr_date_to_string,
+    '$meta': _expr_meta,
+}
+
+def _evaluate(expression, document):
+    """Evaluates an aggregation expression ('$field', operators, literals) against a document."""
+    if isinstance(expression, str) and expression.startswith('$'):
+        if expression == '$$ROOT':
+            return document
+        return _get_field(document, expression[1:])
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator, args = next(iter(expression.items()))
+            if operator.startswith('$'):
+                if operator not in EXPRESSION_OPERATORS:
+                    raise ValueError(f"unknown expression operator: {operator}")
+                return EXPRESSION_OPERATORS[operator](args, document)
+        return {key: _evaluate(value, document) for key, value in expression.items()}
+    if isinstance(expression, list):
+        return [_evaluate(value, document) for value in expression]
+    return expression
+
+
+class _Accumulator:
+    """Running state for one $group accumulator (e.g. {'$sum': '$total_amount'})."""
+    __slots__ = ('operator', 'value', 'count', 'seen')
+    
+    def __init__(self, operator):
+        if operator not in ('$sum', '$avg', '$min', '$max', '$first', '$last', '$push', '$addToSet', '$count'):
+            raise ValueError(f"unknown group operator: {operator}")
+        self.operator = operator
+        self.value = [] if operator in ('$push', '$addToSet') else None
+        self.count = 0
+        self.seen = set() if operator == '$addToSet' else None
+    
+    def add(self, value):
+        operator = self.operator
+        if operator in ('$sum', '$avg'):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.value = (self.value or 0) + value
+                self.count += 1
+        elif operator == '$count':
+            self.count += 1
+        elif operator in ('$min', '$max'):
+            if value is not None and (
+                self.value is None
+                or (operator == '$min' and _sort_key(value) < _sort_key(self.value))
+                or (operator == '$max' and _sort_key(value) > _sort_key(self.value))
+            ):
+                self.value = value
+        elif operator == '$first':
+            if self.count == 0:
+                self.value = value
+            self.count += 1
+        elif operator == '$last':
+            self.value = value
+        elif operator == '$push':
+            self.value.append(value)
+        elif operator == '$addToSet':
+            key = _hashable(value)
+            if key not in self.seen:
+                self.seen.add(key)
+                self.value.append(value)
+    
+    def result(self):
+        if self.operator == '$sum':
+            return self.value or 0
+        if self.operator == '$avg':
+            return self.value / self.count if self.count else None
+        if self.operator == '$count':
+            return self.count
+        return self.value
+
+
+def _stage_match(documents, spec, database):
+    return filter(compile_query(spec), documents)
+
+def _stage_group(documents, spec, database):
+    key_expression = spec['_id']
+    fields = [(name, *next(iter(accumulator.items()))) for name, accumulator in spec.items() if name != '_id']
+    groups = {}
+    for document in documents:
+        key = _evaluate(key_expression, document)
+        hashed = _hashable(key)
+        group = groups.get(hashed)
+        if group is None:
+            group = groups[hashed] = (key, [_Accumulator(operator) for _, operator, _ in fields])
+        for accumulator, (_, _, expression) in zip(group[1], fields):
+            accumulator.add(_evaluate(expression, document))
+    for key, accumulators in groups.values():
+        result = {'_id': key}
+        for accumulator, (name, _, _) in zip(accumulators, fields):
+            result[name] = accumulator.result()
+        yield result
+
+def _stage_sort(documents, spec, database, wanted=None):
+    spec = list(spec.items())
+    if not any(direction == TEXT_SCORE for _, direction in spec):
+        return iter(_sort_documents(documents, spec, wanted))
+    # {'$meta': 'textScore'} sorts by relevance, best first: decorate each
+    # document with its score, sort, then hand back the originals
+    decorated = ({'score': _expr_meta('textScore', document), 'document': document} for document in documents)
+    spec = [('score', -1) if direction == TEXT_SCORE else (f"document.{field}", direction)
+            for field, direction in spec]
+    return (item['document'] for item in _sort_documents(decorated, spec, wanted))
+
+def _stage_skip(documents, spec, database):
+    return itertools.islice(documents, spec, None)
+
+def _stage_limit(documents, spec, database):
+    return itertools.islice(documents, spec)
+
+def _stage_project(documents, spec, database):
+    exclusions = [field for field, value in spec.items() if isinstance(value, (bool, int, float)) and not value]
+    if len(exclusions) == len(spec):
+        for document in documents:
+            result = copy.deepcopy(document) if any('.' in field for field in exclusions) else dict(document)
+            for field in exclusions:
+                _unset_field(result, field)
+            yield result
+        return
+    if any(field != '_id' for field in exclusions):
+        raise ValueError("Cannot mix inclusion and exclusion in $project")
+    for document in documents:
+        result = {}
+        if spec.get('_id', 1) and '_id' in document:
+            result['_id'] = document['_id']
+        for field, value in spec.items():
+            if field == '_id' and isinstance(value, (bool, int, float)):
+                continue
+            if isinstance(value, (bool, int, float)):
+                if _has_field(document, field):
+                    _set_field(result, field, _get_field(document, field))
+            else:
+                _set_field(result, field, _evaluate(value, document))
+        yield result
+
+def _stage_add_fields(documents, spec, database):
+    for document in documents:
+        result = dict(document)
+        for field, expression in spec.items():
+            _set_field(result, field, _evaluate(expression, document))
+        yield result
+
+def _stage_unset(documents, spec, database):
+    return _stage_project(documents, {field: 0 for field in ([spec] if isinstance(spec, str) else spec)}, database)
+
+def _stage_unwind(documents, spec, database):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    for document in documents:
+        values = _get_field(document, path)
+        if isinstance(values, list) and values:
+            for value in values:
+                result = dict(document)
+                _set_field(result, path, value)
+                yield result
+        elif values is not None and not isinstance(values, list):
+            yield document
+        elif preserve:
+            yield document
+
+def _stage_lookup(documents, spec, database):
+    """
+    Equality $lookup as a hash join. An index on the foreign field (or the
+    _id primary key) is probed directly; otherwise the foreign collection is
+    hashed once for the whole pipeline rather than scanned per document.
+    """
+    if 'localField' not in spec:
+        raise ValueError("Only localField/foreignField $lookup is supported by the mock database")
+    foreign = database[spec['from']]
+    local_field, foreign_field, output = spec['localField'], spec['foreignField'], spec['as']
+    foreign._sync()
+    
+    if foreign_field == '_id':
+        def probe(value):
+            with foreign._lock.reading():
+                document = foreign.data.get(value)
+            return [document] if document is not None else []
+    else:
+        with foreign._lock.reading():
+            index = next((index for index in foreign.indexes.values()
+                          if index.fields == [foreign_field] and not index.sparse), None)
+            table = None
+            if index is None:
+                table = {}
+                for document in foreign.data.values():
+                    table.setdefault(_hashable(_get_field(document, foreign_field)), []).append(document)
+        if index is not None:
+            def probe(value):
+                with foreign._lock.reading():
+                    return index.lookup((_hashable(value),))
+        else:
+            probe = lambda value: list(table.get(_hashable(value), []))
+    
+    for document in documents:
+        value = _get_field(document, local_field)
+        if isinstance(value, list):
+            matches = {}
+            for element in value:
+                for match in probe(element):
+                    matches[id(match)] = match
+            matches = list(matches.values())
+        else:
+            matches = probe(value)
+        result = dict(document)
+        _set_field(result, output, matches)
+        yield result
+
+def _stage_bucket(documents, spec, database):
+    """
+    Groups documents into the ranges [boundaries[i], boundaries[i + 1]) of a
+    numeric groupBy value, finding each document's range with bisect. Values
+    outside every range (or not numbers) go to the 'default' bucket.
+    """
+    boundaries = spec['boundaries']
+    if len(boundaries) < 2 or list(boundaries) != sorted(boundaries):
+        raise ValueError("The $bucket 'boundaries' field must be an array of at least two values in ascending order")
+    output = spec.get('output') or {'count': {'$sum': 1}}
+    fields = [(name, *next(iter(accumulator.items()))) for name, accumulator in output.items()]
+    groups = {}
+    for document in documents:
+        value = _evaluate(spec['groupBy'], document)
+        if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and boundaries[0] <= value < boundaries[-1]):
+            key = (0, boundaries[bisect.bisect_right(boundaries, value) - 1])
+        elif 'default' in spec:
+            key = (1, spec['default'])
+        else:
+            raise ValueError("$bucket could not find a matching branch for an input, and no default was specified")
+        accumulators = groups.get(key)
+        if accumulators is None:
+            accumulators = groups[key] = [_Accumulator(operator) for _, operator, _ in fields]
+        for accumulator, (_, _, expression) in zip(accumulators, fields):
+            accumulator.add(_evaluate(expression, document))
+    # Buckets come out in boundary order, the default bucket last
+    for key in sorted(groups, key=lambda key: (key[0], _sort_key(key[1]))):
+        result = {'_id': key[1]}
+        for accumulator, (name, _, _) in zip(groups[key], fields):
+            result[name] = accumulator.result()
+        yield result
+
+def _stage_facet(documents, spec, database):
+    """
+    Runs every sub-pipeline over a single pass of the input: each document is
+    read once and routed to the facets whose leading $match it passes (facets
+    sharing a leading $match evaluate it once between them), then the rest
+    of each sub-pipeline runs over its share.
+    """
+    inputs = {}
+    routes = {}  # leading $match -> (predicate, input lists fed by it)
+    for name, pipeline in spec.items():
+        match = pipeline[0]['$match'] if pipeline and '$match' in pipeline[0] else {}
+        key = _hashable(match)
+        if key not in routes:
+            routes[key] = (compile_query(match), [])
+        inputs[name] = []
+        routes[key][1].append(inputs[name])
+    routes = list(routes.values())
+    for document in documents:
+        for predicate, targets in routes:
+            if predicate(document):
+                for target in targets:
+                    target.append(document)
+    result = {}
+    for name, pipeline in spec.items():
+        rest = pipeline[1:] if pipeline and '$match' in pipeline[0] else pipeline
+        result[name] = list(_run_pipeline(inputs[name], rest, database))
+    yield result
+
+def _stage_count(documents, spec, database):
+    count = sum(1 for _ in documents)
+    if count:
+        yield {spec: count}
+
+# Pipeline stage dispatch table: stage -> run(documents, spec, database)
+PIPELINE_STAGES = {
+    '$match': _stage_match,
+    '$group': _stage_group,
+    '$sort': _stage_sort,
+    '$skip': _stage_skip,
+    '$limit': _stage_limit,
+    '$project': _stage_project,
+    '$addFields': _stage_add_fields,
+    '$set': _stage_add_fields,
+    '$unset': _stage_unset,
+    '$unwind': _stage_unwind,
+    '$lookup': _stage_lookup,
+    '$bucket': _stage_bucket,
+    '$facet': _stage_facet,
+    '$count': _stage_count,
+}
+
+def _run_pipeline(documents, pipeline, database):
+    """Chains the pipeline's stages into a generator over ``documents``."""
+    stages = [next(iter(stage.items())) for stage in pipeline]
+    for position, (name, spec) in enumerate(stages):
+        if name not in PIPELINE_STAGES:
+            raise ValueError(f"Unrecognized pipeline stage name: {name}")
+        if name == '$sort':
+            following = stages[position + 1] if position + 1 < len(stages) else None
+            wanted = following[1] if following and following[0] == '$limit' else None
+            documents = _stage_sort(documents, spec, database, wanted)
+        else:
+            documents = PIPELINE_STAGES[name](documents, spec, database)
+    return documents
+
+
+# =============================================================================
+# DOCUMENT ISOLATION
+# =============================================================================
+# Stored documents are never modified in place (writes swap in a new dict),
+# so reads can share them freely inside the engine. Callers, however, get a
+# DocumentView: a shallow copy whose nested dicts/lists are only copied the
+# first time they are fetched, so mutating a result never reaches the store.
+
+def _detach(value):
+    """Copies the dicts and lists in ``value`` into plain, unshared containers."""
+    if isinstance(value, dict):
+        return {key: _detach(item) for key, item in dict.items(value)}
+    if isinstance(value, list):
+        return [_detach(item) for item in value]
+    return value
+
+
+class DocumentView(dict):
+    """A document handed out by a read; safe for the caller to modify."""
+    __slots__ = ('_owned',)
+
+    def __init__(self, document=()):
+        dict.__init__(self, document)
+        self._owned = None
+
+    def _own(self, key, value):
+        # Nested containers may still be shared with the store; copy on first access
+        if isinstance(value, (dict, list)):
+            if self._owned is None:
+                self._owned = set()
+            if key not in self._owned:
+                value = _detach(value)
+                dict.__setitem__(self, key, value)
+                self._owned.add(key)
+        return value
+
+    def _claim(self, keys):
+        if self._owned is None:
+            self._owned = set()
+        self._owned.update(keys)
+
+    def __getitem__(self, key):
+        return self._own(key, dict.__getitem__(self, key))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._claim((key,))
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = self[key]
+        dict.__delitem__(self, key)
+        return value
+
+    def popitem(self):
+        key = next(reversed(self))
+        return key, self.pop(key)
+
+    def update(self, *args, **kwargs):
+        changes = dict(*args, **kwargs)
+        dict.update(self, changes)
+        self._claim(changes)
+
+    # Overriding __iter__ makes dict(view), {**view} and dict.update(view) go
+    # through keys() and __getitem__ instead of copying the raw entries, so
+    # every copy of a view gets its own nested containers
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def keys(self):
+        return dict.keys(self)
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def copy(self):
+        return DocumentView(self)
+
+    def __copy__(self):
+        return DocumentView(self)
+
+    def __deepcopy__(self, memo):
+        return _detach(self)
+
+    def __reduce__(self):
+        return dict, (_detach(self),)
+
+
+# =============================================================================
+# UPDATE ENGINE
+# =============================================================================
+# Update operators work on a shallow copy of the stored document and copy
+# each nested dict/list on the path they change, so the previous version
+# (which readers may still hold) is left untouched. The paths an update
+# touches are reported back so only the indexes over them are re-keyed.
+
+def _writable_parent(document, path, create=True):
+    """Returns (container, last key) for ``path``, copying nested dicts on the way."""
+    parts = path.split('.')
+    for part in parts[:-1]:
+        child = document.get(part)
+        if isinstance(child, dict):
+            child = dict(child)
+        elif child is None and create:
+            child = {}
+        elif child is None:
+            return None, parts[-1]
+        else:
+            raise ValueError(f"Cannot create field '{part}' in element {{{part}: {child!r}}}")
+        document[part] = child
+        document = child
+    return document, parts[-1]
+
+def _array_at(parent, key, operator):
+    current = parent.get(key)
+    if current is None:
+        return []
+    if not isinstance(current, list):
+        raise ValueError(f"Cannot apply {operator} to a non-array field '{key}'")
+    return list(current)
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return [_detach(item) for item in value['$each']]
+    return [_detach(value)]
+
+def _element_matcher(condition):
+    """Predicate for $pull: a query for embedded documents, operators or a literal for scalars."""
+    if isinstance(condition, dict):
+        if condition and all(key.startswith('$') for key in condition):
+            matches = compile_query({'value': condition})
+            return lambda item: matches({'value': item})
+        matches = compile_query(condition)
+        return lambda item: isinstance(item, dict) and matches(item)
+    return lambda item: item == condition
+
+def _update_set(document, path, value):
+    parent, key = _writable_parent(document, path)
+    parent[key] = _detach(value)
+
+def _update_unset(document, path, value):
+    parent, key = _writable_parent(document, path, create=False)
+    if parent is not None:
+        parent.pop(key, None)
+
+def _update_inc(document, path, value):
+    parent, key = _writable_parent(document, path)
+    current = parent.get(key, 0)
+    if len(_numbers([current, value])) != 2:
+        raise ValueError(f"Cannot apply $inc to a value of non-numeric type at '{path}'")
+    parent[key] = current + value
+
+def _update_push(document, path, value):
+    parent, key = _writable_parent(document, path)
+    parent[key] = _array_at(parent, key, '$push') + _each(value)
+
+def _update_add_to_set(document, path, value):
+    parent, key = _writable_parent(document, path)
+    items = _array_at(parent, key, '$addToSet')
+    for item in _each(value):
+        if item not in items:
+            items.append(item)
+    parent[key] = items
+
+def _update_pull(document, path, value):
+    parent, key = _writable_parent(document, path, create=False)
+    if parent is None or parent.get(key) is None:
+        return
+    matches = _element_matcher(value)
+    parent[key] = [item for item in _array_at(parent, key, '$pull') if not matches(item)]
+
+UPDATE_OPERATORS = {
+    '$set': _update_set,
+    '$setOnInsert': _update_set,
+    '$unset': _update_unset,
+    '$inc': _update_inc,
+    '$push': _update_push,
+    '$addToSet': _update_add_to_set,
+    '$pull': _update_pull,
+}
+
+def _apply_update(document, update, inserting=False):
+    """Returns (updated copy of ``document``, list of changed paths)."""
+    if not update or not all(operator.startswith('$') for operator in update):
+        raise ValueError('update only works with $ operators')
+    updated = dict(document)
+    fields = []
+    for operator, changes in update.items():
+        if operator not in UPDATE_OPERATORS:
+            raise ValueError(f"Unknown modifier: {operator}")
+        if operator == '$setOnInsert' and not inserting:
+            continue
+        for path, value in changes.items():
+            if path == '_id' or path.startswith('_id.'):
+                raise ValueError("Performing an update on the path '_id' would modify the immutable field '_id'")
+            UPDATE_OPERATORS[operator](updated, path, value)
+            fields.append(path)
+    return updated, fields
+
+def _upsert_seed(query):
+    """The document an upsert starts from: the query's equality conditions."""
+    seed = {}
+    for field, condition in query.items():
+        if field.startswith('$'):
+            continue
+        if isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+            if '$eq' in condition:
+                _set_field(seed, field, _detach(condition['$eq']))
+            continue
+        _set_field(seed, field, _detach(condition))
+    return seed
+
+
+class ReadWriteLock:
+    """
+    Lets any number of readers in at once, or a single writer. Waiting
+    writers hold back new readers so they can't be starved. Both sides are
+    re-entrant for the owning thread (a writer may also read), which keeps
+    e.g. a $lookup back into the same collection from deadlocking.
+    """
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+    
+    @contextlib.contextmanager
+    def reading(self):
+        held = getattr(self._local, 'reads', 0)
+        if held or self._writer == threading.get_ident():
+            self._local.reads = held + 1
+            try:
+                yield
+            finally:
+                self._local.reads = held
+            return
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+    
+    @contextlib.contextmanager
+    def writing(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+class MockIndex:
+    """
+    A secondary index over one or more fields of a MockCollection.
+    Equality lookups go through a hash map of key -> documents; range lookups
+    bisect a sorted list of the distinct keys, rebuilt lazily after writes.
+    Compound indexes also map their leading field alone, so (like MongoDB)
+    they serve queries on that prefix.
+    """
+    text = False
+
+    def __init__(self, name, keys, unique=False, sparse=False, **options):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, _ in keys]
+        self.unique = unique
+        self.sparse = sparse
+        self.options = options
+        self.hashed = any(direction == 'hashed' for _, direction in keys)
+        self.entries = {}
+        self.leading = {} if len(self.fields) > 1 else None
+        # (sorted distinct keys, their sort keys), rebuilt lazily after writes
+        self._sorted = None
+
+    def keys_for(self, document):
+        """
+        The index keys of a document. Like MongoDB's multikey indexes, an
+        array field is indexed under each of its elements (and, so whole-array
+        lookups still work, under the array itself).
+        """
+        parts = [_get_field(document, field) for field in self.fields]
+        if not any(isinstance(part, list) for part in parts):
+            return [tuple(_hashable(part) for part in parts)]
+        options = [[_hashable(part)] + [_hashable(element) for element in part] if isinstance(part, list)
+                   else [_hashable(part)] for part in parts]
+        return list(dict.fromkeys(itertools.product(*options)))
+
+    def _skips(self, key):
+        return self.sparse and all(part is None for part in key)
+
+    def check(self, doc_id, document):
+        """Raises DuplicateKeyError if adding the document would break uniqueness."""
+        if not self.unique:
+            return
+        for key in self.keys_for(document):
+            if self._skips(key):
+                continue
+            bucket = self.entries.get(key)
+            if bucket and doc_id not in bucket:
+                raise DuplicateKeyError(
+                    f"E11000 duplicate key error index: {self.name} dup key: {dict(zip(self.fields, key))}"
+                )
+
+    def add(self, doc_id, document):
+        for key in self.keys_for(document):
+            if self._skips(key):
+                continue
+            bucket = self.entries.get(key)
+            if bucket is None:
+                bucket = self.entries[key] = {}
+                self._sorted = None
+            bucket[doc_id] = document
+            if self.leading is not None:
+                self.leading.setdefault(key[0], {})[doc_id] = document
+
+    def remove(self, doc_id, document):
+        for key in self.keys_for(document):
+            bucket = self.entries.get(key)
+            if bucket is None:
+                continue
+            bucket.pop(doc_id, None)
+            if not bucket:
+                del self.entries[key]
+                self._sorted = None
+            if self.leading is not None:
+                prefix = self.leading.get(key[0], {})
+                prefix.pop(doc_id, None)
+                if not prefix:
+                    self.leading.pop(key[0], None)
+
+    def replace(self, doc_id, old, new, rekey=True):
+        """Points the index at a new version of a document, moving it only if its keys changed."""
+        keys = self.keys_for(old)
+        if rekey and self.keys_for(new) != keys:
+            self.remove(doc_id, old)
+            self.add(doc_id, new)
+            return
+        for key in keys:
+            bucket = self.entries.get(key)
+            if bucket is not None and doc_id in bucket:
+                bucket[doc_id] = new
+                if self.leading is not None:
+                    self.leading[key[0]][doc_id] = new
+
+    def lookup(self, key):
+        return list(self.entries.get(key, {}).values())
+
+    def lookup_leading(self, value):
+        """Documents whose first indexed field equals ``value`` (compound indexes only)."""
+        return list(self.leading.get(value, {}).values())
+
+    def supports_range(self):
+        return not self.hashed and len(self.fields) == 1
+
+    def range(self, condition):
+        """Returns the documents whose key falls within a $gt/$gte/$lt/$lte condition."""
+        if self._sorted is None:
+            # Assigned as one tuple so concurrent readers never see half a rebuild
+            keys = sorted(self.entries, key=lambda key: _sort_key(key[0]))
+            self._sorted = (keys, [_sort_key(key[0]) for key in keys])
+        sorted_keys, sort_keys = self._sorted
+        lo, hi = 0, len(sort_keys)
+        if '$gt' in condition:
+            lo = max(lo, bisect.bisect_right(sort_keys, _sort_key(condition['$gt'])))
+        if '$gte' in condition:
+            lo = max(lo, bisect.bisect_left(sort_keys, _sort_key(condition['$gte'])))
+        if '$lt' in condition:
+            hi = min(hi, bisect.bisect_left(sort_keys, _sort_key(condition['$lt'])))
+        if '$lte' in condition:
+            hi = min(hi, bisect.bisect_right(sort_keys, _sort_key(condition['$lte'])))
+        # Keyed by _id: a multikey document can fall in the range more than once
+        documents = {}
+        for key in sorted_keys[lo:hi]:
+            documents.update(self.entries[key])
+        return list(documents.values())
+
+    def touches(self, fields):
+        """Whether an update to any of ``fields`` can change this index's keys."""
+        for changed in fields:
+            for field in self.fields:
+                if changed == field or changed.startswith(field + '.') or field.startswith(changed + '.'):
+                    return True
+        return False
+
+
+_TEXT_TOKEN = re.compile(r'[^\W_]+')
+_STOP_WORDS = frozenset('a an and are as at be by for from in is it its of on or the to with'.split())
+
+def _stem(token):
+    """Very light English stemming, so 'cakes' finds 'cake' and 'berries' finds 'berry'."""
+    if len(token) > 4 and token.endswith('ies'):
+        return token[:-3] + 'y'
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+def _text_tokens(text):
+    return [_stem(token) for token in _TEXT_TOKEN.findall(text.lower()) if token not in _STOP_WORDS]
+
+
+class _TextMatches(list):
+    """The documents a $text search matched, with their relevance scores by _id."""
+    def __init__(self, documents, scores):
+        super().__init__(documents)
+        self.scores = scores
+
+
+class MockTextIndex(MockIndex):
+    """
+    Inverted index behind $text queries: token -> {doc_id: weight}, where the
+    weight sums the field weights of every occurrence. A search term matches
+    whole tokens and, at half weight, tokens it is a prefix of (found by
+    bisecting the sorted vocabulary), so partial words typed into the search
+    box still find results.
+    """
+    text = True
+
+    def __init__(self, name, keys, unique=False, sparse=False, **options):
+        super().__init__(name, keys, unique=unique, sparse=sparse, **options)
+        self.weights = {field: options.get('weights', {}).get(field, 1) for field in self.fields}
+        self.postings = {}
+        self.documents = {}
+        # Sorted tokens for prefix lookups, rebuilt lazily after the vocabulary changes
+        self._vocabulary = None
+
+    def _token_weights(self, document):
+        weights = {}
+        for field, weight in self.weights.items():
+            value = _get_field(document, field)
+            values = value if isinstance(value, list) else [value]
+            for item in values:
+                if isinstance(item, str):
+                    for token in _text_tokens(item):
+                        weights[token] = weights.get(token, 0) + weight
+        return weights
+
+    def check(self, doc_id, document):
+        pass
+
+    def add(self, doc_id, document):
+        for token, weight in self._token_weights(document).items():
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = {}
+                self._vocabulary = None
+            posting[doc_id] = weight
+        self.documents[doc_id] = document
+
+    def remove(self, doc_id, document):
+        for token in self._token_weights(document):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[token]
+                self._vocabulary = None
+        self.documents.pop(doc_id, None)
+
+    def replace(self, doc_id, old, new, rekey=True):
+        if rekey:
+            self.remove(doc_id, old)
+            self.add(doc_id, new)
+        elif doc_id in self.documents:
+            self.documents[doc_id] = new
+
+    def lookup(self, key):
+        return []
+
+    def supports_range(self):
+        return False
+
+    def search(self, text):
+        """Returns the matching documents along with their relevance scores."""
+        vocabulary = self._vocabulary
+        if vocabulary is None:
+            vocabulary = self._vocabulary = sorted(self.postings)
+        scores = {}
+        for term in set(_text_tokens(text)):
+            position = bisect.bisect_left(vocabulary, term)
+            while position < len(vocabulary) and vocabulary[position].startswith(term):
+                token = vocabulary[position]
+                factor = 1.0 if token == term else 0.5
+                for doc_id, weight in self.postings[token].items():
+                    scores[doc_id] = scores.get(doc_id, 0) + weight * factor
+                position += 1
+        return _TextMatches([self.documents[doc_id] for doc_id in scores], scores)
+
+
+class _PinnedScan:
+    """
+    Iterates a collection's document dict while it is pinned: writers that
+    find the dict pinned copy it before changing anything, so the scan keeps
+    a consistent snapshot without holding the read lock between documents.
+    """
+    def __init__(self, collection):
+        self._lock = collection._pin_lock
+        self._pins = collection._pins
+        with self._lock:
+            self._pins[0] += 1
+        self._iterator = iter(collection.data.values())
+        self._released = False
+    
+    def __iter__(self):
+        return self
+    
+    def __next__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            self.release()
+            raise
+    
+    def release(self):
+        if not self._released:
+            self._released = True
+            with self._lock:
+                self._pins[0] -= 1
+    
+    def __del__(self):
+        self.release()
+
+
 class MockCollection:
-    def __init__(self, name):
+    """
+    Thread-safe in-memory collection. Each collection has its own
+    reader/writer lock, so requests touching different collections never
+    contend, reads run concurrently, and writers only exclude readers of the
+    same collection for the length of the change. Stored documents are never
+    mutated in place: updates store a new copy (copy-on-write), so a reader
+    holding a document always sees one consistent version.
+    """
+    def __init__(self, name, database=None):
         self.name = name
-        self.data = []
+        self.database = database
+        # Documents keyed by _id, which doubles as the primary (_id_) index
+        self.data = {}
+        self.indexes = {}
+        self._next_id = 1
+        self._lock = ReadWriteLock()
+        # Number of scans pinning the current self.data (see _PinnedScan)
+        self._pin_lock = threading.Lock()
+        self._pins = [0]
+    
+    # --- Persistence hooks (no-ops unless the database is file-backed) ---
+    
+    def _storage(self):
+        return self.database.storage if self.database is not None else None
+    
+    def _sync(self):
+        """Applies writes other processes have appended to the shared journal."""
+        storage = self._storage()
+        if storage is not None:
+            storage.catch_up()
+    
+    @contextlib.contextmanager
+    def _writing(self):
+        """Holds the journal transaction (when file-backed) and this collection's write lock."""
+        storage = self._storage()
+        with storage.transaction() if storage is not None else contextlib.nullcontext():
+            with self._lock.writing():
+                self._unpin()
+                yield
+    
+    def _journal(self, operation, *args):
+        storage = self._storage()
+        if storage is not None:
+            storage.append(self.name, operation, args)
+    
+    def _unpin(self):
+        """Copies self.data if a scan is iterating it, so writes don't disturb the scan."""
+        with self._pin_lock:
+            if self._pins[0]:
+                self.data = dict(self.data)
+                self._pins = [0]
+    
+    def _put(self, document):
+        """Stores a full document image, replacing any document with the same _id."""
+        doc_id = document['_id']
+        existing = self.data.get(doc_id)
+        for index in self.indexes.values():
+            index.check(doc_id, document)
+        if existing is not None:
+            self._unindex_document(doc_id, existing)
+        self._index_document(doc_id, document)
+        self.data[doc_id] = document
+    
+    def _replace(self, doc_id, old, new, fields):
+        """Swaps in an updated document, re-keying only the indexes over changed fields."""
+        touched = {name for name, index in self.indexes.items() if index.touches(fields)}
+        for name in touched:
+            self.indexes[name].check(doc_id, new)
+        for name, index in self.indexes.items():
+            index.replace(doc_id, old, new, rekey=name in touched)
+        self.data[doc_id] = new
+    
+    def _remove(self, doc_id):
+        document = self.data.pop(doc_id, None)
+        if document is not None:
+            self._unindex_document(doc_id, document)
+    
+    def _apply(self, operation, args):
+        """Applies one journaled operation while replaying the write-ahead log."""
+        with self._lock.writing():
+            self._unpin()
+            if operation == 'put':
+                for document in args:
+                    self._put(document)
+            elif operation == 'delete':
+                for doc_id in args[0]:
+                    self._remove(doc_id)
+            elif operation == 'create_index':
+                self._build_index(*args)
+            elif operation == 'drop_index':
+                self.indexes.pop(args[0], None)
     
-    def find(self, query=None):
+    def _dump(self):
+        # Indexes are pickled with their entries (pickle keeps the documents
+        # shared with self.data), so loading a snapshot doesn't rebuild them
+        with self._lock.reading():
+            return {'data': self.data, 'indexes': self.indexes, 'next_id': self._next_id}
+    
+    def _restore(self, state):
+        """Replaces the collection's contents with a snapshot (or empties it for None)."""
+        state = state or {'data': {}, 'indexes': {}, 'next_id': 1}
+        with self._lock.writing():
+            self.data = state['data']
+            self.indexes = state['indexes']
+            self._next_id = state['next_id']
+            self._pins = [0]
+    
+    # --- Index management ---
+    
+    def _build_index(self, name, keys, unique, sparse, options):
+        index_class = MockTextIndex if any(direction == 'text' for _, direction in keys) else MockIndex
+        index = index_class(name, keys, unique=unique, sparse=sparse, **options)
+        for doc_id, document in self.data.items():
+            index.check(doc_id, document)
+            index.add(doc_id, document)
+        self.indexes[name] = index
+    
+    def create_index(self, keys, unique=False, sparse=False, name=None, **options):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        if name is None:
+            name = '_'.join(f"{field}_{direction}" for field, direction in keys)
+        with self._writing():
+            if name not in self.indexes:
+                self._build_index(name, keys, unique, sparse, options)
+                self._journal('create_index', name, keys, unique, sparse, options)
+        return name
+    
+    def drop_index(self, name):
+        with self._writing():
+            if self.indexes.pop(name, None) is not None:
+                self._journal('drop_index', name)
+    
+    def index_information(self):
+        self._sync()
+        with self._lock.reading():
+            info = {'_id_': {'key': [('_id', 1)]}}
+            for name, index in self.indexes.items():
+                info[name] = {'key': list(index.keys), 'unique': index.unique, 'sparse': index.sparse, **index.options}
+            return info
+    
+    def _plan(self, query):
+        """
+        Picks the narrowest index that applies to the query. Returns
+        (index name, documents), or (None, None) when no index applies and
+        every document has to be scanned; callers still filter the documents
+        with compile_query. Must be called with the collection's lock held.
+        """
+        if '$text' in query:
+            index = next((index for index in self.indexes.values() if index.text), None)
+            if index is None:
+                raise ValueError("text index required for $text query")
+            return index.name, index.search(query['$text']['$search'])
+        try:
+            if '_id' in query and not isinstance(query['_id'], dict):
+                document = self.data.get(query['_id'])
+                return '_id_', [document] if document is not None else []
+            
+            equalities = {}
+            memberships = {}
+            ranges = {}
+            for field, condition in query.items():
+                if field.startswith('$'):
+                    continue
+                if isinstance(condition, dict) and any(op.startswith('$') for op in condition):
+                    if '$eq' in condition:
+                        equalities[field] = condition['$eq']
+                    elif '$in' in condition:
+                        memberships[field] = condition['$in']
+                    elif any(op in condition for op in RANGE_OPERATORS):
+                        ranges[field] = condition
+                else:
+                    equalities[field] = condition
+            
+            # A sparse index leaves out documents missing all of its fields,
+            # so it can't answer a lookup for None (null or missing)
+            def covers(index, values):
+                return not index.sparse or any(value is not None for value in values)
+            
+            best = None
+            for index in self.indexes.values():
+                if (not index.text and all(field in equalities for field in index.fields)
+                        and covers(index, [equalities[field] for field in index.fields])):
+                    if best is None or (index.unique, len(index.fields)) > (best.unique, len(best.fields)):
+                        best = index
+            if best is not None:
+                return best.name, best.lookup(tuple(_hashable(equalities[field]) for field in best.fields))
+            
+            for index in self.indexes.values():
+                if (index.leading is not None and index.fields[0] in equalities
+                        and covers(index, [equalities[index.fields[0]]])):
+                    return index.name, index.lookup_leading(_hashable(equalities[index.fields[0]]))
+            
+            for index in self.indexes.values():
+                if (not index.text and len(index.fields) == 1 and index.fields[0] in memberships
+                        and (not index.sparse or None not in memberships[index.fields[0]])):
+                    documents = {}
+                    for value in memberships[index.fields[0]]:
+                        for document in index.lookup((_hashable(value),)):
+                            documents[id(document)] = document
+                    return index.name, list(documents.values())
+            
+            for index in self.indexes.values():
+                if (index.supports_range() and index.fields[0] in ranges
+                        and (not index.sparse or None not in ranges[index.fields[0]].values())):
+                    return index.name, index.range(ranges[index.fields[0]])
+        except TypeError:
+            # Unhashable query values (e.g. the fallback ObjectId) can't use an index
+            pass
+        return None, None
+    
+    def _candidates(self, query, pin=True):
+        """
+        The documents the query has to look at: an index's matches, or every
+        document when no index applies. Readers get a pinned scan, writers
+        (which hold the write lock) the plain dict view.
+        """
+        _, documents = self._plan(query)
+        if documents is not None:
+            return documents
+        return _PinnedScan(self) if pin else self.data.values()
+    
+    def _index_document(self, doc_id, document, indexes=None):
+        indexes = list(self.indexes.values()) if indexes is None else indexes
+        for index in indexes:
+            index.check(doc_id, document)
+        for index in indexes:
+            index.add(doc_id, document)
+    
+    def _unindex_document(self, doc_id, document, indexes=None):
+        indexes = self.indexes.values() if indexes is None else indexes
+        for index in indexes:
+            index.remove(doc_id, document)
+    
+    def find(self, query=None, projection=None):
         if query is None:
             query = {}
-        return MockCursor(self.data, query)
+        self._sync()
+        with self._lock.reading():
+            index_name, documents = self._plan(query)
+            if documents is None:
+                documents = _PinnedScan(self)
+            return MockCursor(documents, query, index_name, projection)
     
-    def find_one(self, query):
+    def find_one(self, query=None, projection=None):
         if query is None:
             query = {}
-        for item in self.data:
-            if self._matches_query(item, query):
-                return item
-        return None
+        self._sync()
+        matches = compile_query(query)
+        with self._lock.reading():
+            found = next((item for item in self._candidates(query) if matches(item)), None)
+        if found is None:
+            return None
+        if projection:
+            found = next(_stage_project([found], projection, None))
+        return DocumentView(found)
+    
+    # --- Writes ---
+    # The _insert/_update/_delete helpers run under the write lock and return
+    # the journal records for what they changed; public methods wrap them in
+    # one transaction each, bulk_write wraps a whole batch.
+    
+    def _insert(self, document):
+        if '_id' not in document:
+            while f"mock_{self._next_id}" in self.data:
+                self._next_id += 1
+            document['_id'] = f"mock_{self._next_id}"
+            self._next_id += 1
+        doc_id = document['_id']
+        if doc_id in self.data:
+            raise DuplicateKeyError(f"E11000 duplicate key error index: _id_ dup key: {{'_id': {doc_id!r}}}")
+        # Store our own copy so later changes to the caller's dict don't leak in
+        stored = _detach(document)
+        self._index_document(doc_id, stored)
+        self.data[doc_id] = stored
+        return [('put', stored)]
+    
+    def _update(self, query, update, upsert=False, multi=False, result=None):
+        if result is None:
+            result = MockResult()
+        matches = compile_query(query)
+        candidates = filter(matches, self._candidates(query, pin=False))
+        # Materialise the matches first: _replace rewrites the buckets we'd be iterating
+        items = list(candidates) if multi else list(itertools.islice(candidates, 1))
+        changes = []
+        try:
+            for item in items:
+                result.matched_count += 1
+                updated, fields = _apply_update(item, update)
+                if updated == item:
+                    continue
+                self._replace(item['_id'], item, updated, fields)
+                changes.append(('put', updated))
+                result.modified_count += 1
+            if not items and upsert:
+                document, _ = _apply_update(_upsert_seed(query), update, inserting=True)
+                changes.extend(self._insert(document))
+                result.upserted_id = document['_id']
+        finally:
+            # Journal whatever was applied, even if a later document failed
+            self._journal_changes(changes)
+        return result
+    
+    def _delete(self, query, multi=False):
+        matches = compile_query(query)
+        candidates = filter(matches, self._candidates(query, pin=False))
+        deleted = [item['_id'] for item in (candidates if multi else itertools.islice(candidates, 1))]
+        for doc_id in deleted:
+            self._remove(doc_id)
+        return [('delete', doc_id) for doc_id in deleted]
+    
+    def _journal_changes(self, changes):
+        """Journals changes in order, one record per run of puts or deletes."""
+        for operation, run in itertools.groupby(changes, key=lambda change: change[0]):
+            values = [value for _, value in run]
+            if operation == 'put':
+                self._journal('put', *values)
+            else:
+                self._journal('delete', values)
     
     def insert_one(self, document):
-        document['_id'] = f"mock_{len(self.data) + 1}"
-        self.data.append(document)
-        return MockResult(document['_id'])
-    
-    def update_one(self, query, update):
-        for i, item in enumerate(self.data):
-            if self._matches_query(item, query):
-                if '$set' in update:
-                    self.data[i].update(update['$set'])
-                return MockResult(item.get('_id'))
-        return MockResult(None)
+        with self._writing():
+            self._journal_changes(self._insert(document))
+        return MockResult(inserted_id=document['_id'])
+    
+    def update_one(self, query, update, upsert=False):
+        with self._writing():
+            return self._update(query, update, upsert=upsert)
+    
+    def update_many(self, query, update, upsert=False):
+        with self._writing():
+            return self._update(query, update, upsert=upsert, multi=True)
+    
+    def find_one_and_update(self, query, update, projection=None, sort=None, upsert=False, return_document=False):
+        """
+        Updates the first match atomically and returns it as it was before the
+        update, or after it when ``return_document`` is true
+        (pymongo's ReturnDocument.AFTER).
+        """
+        with self._writing():
+            matches = compile_query(query)
+            candidates = filter(matches, self._candidates(query, pin=False))
+            if sort:
+                candidates = _sort_documents(candidates, list(sort), 1)
+            item = next(iter(candidates), None)
+            if item is not None:
+                updated, fields = _apply_update(item, update)
+                if updated != item:
+                    self._replace(item['_id'], item, updated, fields)
+                    self._journal_changes([('put', updated)])
+                found = updated if return_document else item
+            elif upsert:
+                document, _ = _apply_update(_upsert_seed(query), update, inserting=True)
+                self._journal_changes(self._insert(document))
+                found = document if return_document else None
+            else:
+                found = None
+        if found is None:
+            return None
+        if projection:
+            found = next(_stage_project([found], projection, None))
+        return DocumentView(found)
     
     def delete_one(self, query):
-        for i, item in enumerate(self.data):
-            if self._matches_query(item, query):
-                del self.data[i]
-                return MockResult(item.get('_id'))
-        return MockResult(None)
+        with self._writing():
+            changes = self._delete(query)
+            self._journal_changes(changes)
+        return MockResult(deleted_count=len(changes))
     
     def delete_many(self, query):
-        count = 0
-        for i in range(len(self.data) - 1, -1, -1):
-            if self._matches_query(self.data[i], query):
-                del self.data[i]
-                count += 1
-        return MockResult(count)
+        with self._writing():
+            changes = self._delete(query, multi=True)
+            self._journal_changes(changes)
+        return MockResult(deleted_count=len(changes))
+    
+    def bulk_write(self, requests):
+        """Applies a batch of InsertOne/UpdateOne/UpdateMany/DeleteOne/DeleteMany requests."""
+        result = MockBulkWriteResult()
+        with self._writing():
+            for position, request in enumerate(requests):
+                if isinstance(request, InsertOne):
+                    self._journal_changes(self._insert(request._doc))
+                    result.inserted_count += 1
+                elif isinstance(request, (UpdateOne, UpdateMany)):
+                    result.upserted_id = None
+                    self._update(request._filter, request._doc, upsert=request._upsert,
+                                 multi=isinstance(request, UpdateMany), result=result)
+                    if result.upserted_id is not None:
+                        result.upserted_ids[position] = result.upserted_id
+                elif isinstance(request, (DeleteOne, DeleteMany)):
+                    changes = self._delete(request._filter, multi=isinstance(request, DeleteMany))
+                    self._journal_changes(changes)
+                    result.deleted_count += len(changes)
+                else:
+                    raise TypeError(f"{request!r} is not a valid request")
+        result.upserted_count = len(result.upserted_ids)
+        return result
     
     def count_documents(self, query=None):
         if query is None:
             query = {}
-        count = 0
-        for item in self.data:
-            if self._matches_query(item, query):
-                count += 1
-        return count
+        self._sync()
+        with self._lock.reading():
+            if not query:
+                return len(self.data)
+            count = 0
+            matches = compile_query(query)
+            for item in self._candidates(query, pin=False):
+                if matches(item):
+                    count += 1
+            return count
+    
+    def estimated_document_count(self):
+        self._sync()
+        return len(self.data)
     
     def distinct(self, field):
+        self._sync()
         values = set()
-        for item in self.data:
-            if field in item:
-                values.add(item[field])
+        with self._lock.reading():
+            for item in self.data.values():
+                if field in item:
+                    values.add(item[field])
         return list(values)
     
     def aggregate(self, pipeline):
-        # Simple aggregation for basic operations
-        if pipeline and '$group' in pipeline[0]:
-            group_op = pipeline[0]['$group']
-            if group_op.get('_id') is None and 'total_sales' in group_op:
-                total = sum(item.get('total_amount', 0) for item in self.data)
-                return [{'total_sales': total}]
-        return []
-    
-    def _matches_query(self, item, query):
-        for key, value in query.items():
-            if key == '_id':
-                if item.get('_id') != value:
-                    return False
-            elif key == '$ne':
-                if item.get('_id') == value:
-                    return False
-            elif isinstance(value, dict) and '$regex' in value:
-                import re
-                pattern = value['$regex']
-                flags = 0
-                if value.get('$options') == 'i':
-                    flags = re.IGNORECASE
-                if not re.search(pattern, str(item.get(key, '')), flags):
-                    return False
-            elif item.get(key) != value:
-                return False
-        return True
+        self._sync()
+        with self._lock.reading():
+            if pipeline and '$match' in pipeline[0]:
+                # A leading $match can be served from an index
+                documents = self._candidates(pipeline[0]['$match'])
+            else:
+                documents = _PinnedScan(self)
+        scores = getattr(documents, 'scores', None)
+        if scores is not None:
+            # $text matches carry their relevance for {'$meta': 'textScore'}
+            documents = [_Scored(document, scores[document['_id']]) for document in documents]
+        return map(DocumentView, _run_pipeline(documents, pipeline, self.database))
+
 
 class MockCursor:
-    def __init__(self, data, query):
+    """
+    Lazily evaluated cursor: nothing is scanned until iteration starts, and
+    documents then stream through filter -> sort -> skip -> limit, so an
+    unsorted limit(n) stops scanning after n matches.
+    """
+    def __init__(self, data, query, index_name=None, projection=None):
         self.data = data
         self.query = query
-        self.filtered_data = [item for item in data if self._matches_query(item, query)]
-        self.index = 0
+        self.index_name = index_name
+        self.projection = projection
         self.limit_val = None
         self.skip_val = 0
         self.sort_val = None
+        self._iterator = None
     
-    def sort(self, field, direction):
-        self.sort_val = (field, direction)
+    def sort(self, key_or_list, direction=1):
+        if isinstance(key_or_list, str):
+            self.sort_val = [(key_or_list, direction)]
+        else:
+            self.sort_val = list(key_or_list)
         return self
     
     def limit(self, n):
@@ -116,57 +1801,119 @@ class MockCursor:
         self.skip_val = n
         return self
     
+    def _execute(self):
+        if self.query:
+            documents = filter(compile_query(self.query), self.data)
+        else:
+            documents = iter(self.data)
+        projection = dict(self.projection or {})
+        sort = self.sort_val
+        # {'$meta': 'textScore'} fields carry the relevance of a $text search;
+        # sorting on one puts the best matches first
+        score_fields = [field for field, value in projection.items() if value == TEXT_SCORE]
+        if sort:
+            score_fields += [field for field, direction in sort if direction == TEXT_SCORE]
+            sort = [(field, -1 if direction == TEXT_SCORE else direction) for field, direction in sort]
+        scores = getattr(self.data, 'scores', None)
+        if score_fields and scores is not None:
+            documents = (dict(document, **dict.fromkeys(score_fields, scores[document['_id']]))
+                         for document in documents)
+        wanted = self.skip_val + self.limit_val if self.limit_val else None
+        if sort:
+            documents = _sort_documents(documents, sort, wanted)
+        documents = itertools.islice(documents, self.skip_val, wanted)
+        for field in score_fields:
+            projection.pop(field, None)
+        if projection:
+            if any(value for field, value in projection.items() if field != '_id'):
+                # An inclusion projection keeps the requested scores too
+                projection.update(dict.fromkeys(score_fields, 1))
+            documents = _stage_project(documents, projection, None)
+        return map(DocumentView, documents)
+    
+    def explain(self):
+        """A MongoDB-shaped query plan: IDHACK/IXSCAN when an index serves the query, else COLLSCAN."""
+        if self.index_name == '_id_':
+            plan = {'stage': 'IDHACK'}
+        elif self.index_name is not None:
+            plan = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': self.index_name}}
+        else:
+            plan = {'stage': 'COLLSCAN', 'filter': self.query}
+        if self.sort_val:
+            plan = {'stage': 'SORT', 'sortPattern': dict(self.sort_val), 'inputStage': plan}
+        return {'queryPlanner': {'winningPlan': plan}}
+    
     def __iter__(self):
         return self
     
     def __next__(self):
-        if self.index >= len(self.filtered_data):
-            raise StopIteration
-        
-        item = self.filtered_data[self.index]
-        self.index += 1
-        return item
+        if self._iterator is None:
+            self._iterator = self._execute()
+        return next(self._iterator)
     
     def __list__(self):
         return list(self)
     
-    def _matches_query(self, item, query):
-        for key, value in query.items():
-            if key == '_id':
-                if item.get('_id') != value:
-                    return False
-            elif key == '$ne':
-                if item.get('_id') == value:
-                    return False
-            elif isinstance(value, dict) and '$regex' in value:
-                import re
-                pattern = value['$regex']
-                flags = 0
-                if value.get('$options') == 'i':
-                    flags = re.IGNORECASE
-                if not re.search(pattern, str(item.get(key, '')), flags):
-                    return False
-            elif item.get(key) != value:
-                return False
-        return True
 
 class MockResult:
-    def __init__(self, inserted_id):
+    def __init__(self, inserted_id=None, deleted_count=0):
         self.inserted_id = inserted_id
+        self.deleted_count = deleted_count
+        self.matched_count = 0
+        self.modified_count = 0
+        self.upserted_id = None
 
-class MockDatabase:
+class MockBulkWriteResult(MockResult):
     def __init__(self):
+        super().__init__()
+        self.inserted_count = 0
+        self.upserted_count = 0
+        self.upserted_ids = {}
+
+class MockDatabase:
+    """
+    In-memory database. Pass ``path`` to make it durable: writes are then
+    journaled to a write-ahead log under that directory and compacted into
+    snapshots (see mock_storage.MockStorage), and the data survives restarts.
+    """
+    def __init__(self, path=None, **storage_options):
         self.collections = {}
+        self.storage = None
+        self._lock = threading.Lock()
+        if path:
+            from .mock_storage import MockStorage
+            self.storage = MockStorage(path, self, **storage_options)
+    
+    def list_collection_names(self):
+        if self.storage is not None:
+            self.storage.catch_up()
+        return [name for name, collection in self.collections.items() if collection.data]
     
     def __getattr__(self, name):
-        if name not in self.collections:
-            self.collections[name] = MockCollection(name)
-        return self.collections[name]
+        if name.startswith('__'):
+            raise AttributeError(name)
+        collection = self.collections.get(name)
+        if collection is None:
+            with self._lock:
+                collection = self.collections.get(name)
+                if collection is None:
+                    collection = self.collections[name] = MockCollection(name, self)
+        return collection
+    
+    def __getitem__(self, name):
+        return getattr(self, name)
 
 # Initialize mock database with sample data
-def init_mock_db():
-    db = MockDatabase()
-    
+def init_mock_db(path=None):
+    db = MockDatabase(path)
+
+    # Same index declarations as production MongoDB
+    ensure_indexes(db)
+
+    if db.storage is not None and db.list_collection_names():
+        # Durable mode: keep the data persisted by earlier runs
+        return db
+
     # Sample cakes data with your original categories and real images
     sample_cakes = [
         {
@@ -0,0 +1,191 @@
+# Durable file-backed storage for the mock database.
+# Writes are appended to a write-ahead log (WAL) and periodically compacted
+# into a snapshot, so a box without MongoDB keeps its data across restarts.
+
+import mmap
+import os
+import pickle
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process file locking (e.g. Windows): safe for a single process only
+    fcntl = None
+
+SNAPSHOT_FILE = 'snapshot.pickle'
+WAL_FILE = 'wal.log'
+
+# Each WAL record is: payload length, CRC32 of the payload, pickled payload
+RECORD_HEADER = struct.Struct('<II')
+
+
+class MockStorage:
+    """
+    Snapshot + write-ahead log persistence for a MockDatabase.
+
+    Every write takes an exclusive lock on the WAL, first applies any records
+    other processes (e.g. sibling gunicorn workers) appended since it last
+    looked, then applies its own change and appends a full image of each
+    touched document. Reads only replay new records, so every process sees
+    the same totally ordered history. When the WAL grows past
+    ``compact_bytes`` the writer folds it into a fresh snapshot and starts a
+    new, empty WAL; other processes notice the new file and reload.
+    """
+    def __init__(self, path, database, compact_bytes=16 * 1024 * 1024, fsync=False):
+        self.path = path
+        self.database = database
+        self.compact_bytes = compact_bytes
+        self.fsync = fsync
+        self.snapshot_path = os.path.join(path, SNAPSHOT_FILE)
+        self.wal_path = os.path.join(path, WAL_FILE)
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._wal = None
+        self._offset = 0
+        os.makedirs(path, exist_ok=True)
+        with self._lock:
+            self._load()
+
+    # --- Loading -------------------------------------------------------------
+
+    def _open_wal(self):
+        if self._wal is not None:
+            self._wal.close()
+        self._wal = open(self.wal_path, 'a+b')
+        self._offset = 0
+
+    def _load(self):
+        """Loads the snapshot (memory-mapped) and replays the WAL on top of it."""
+        # Reset collections in place so callers holding a collection keep a live one
+        for collection in self.database.collections.values():
+            collection._restore(None)
+        self._open_wal()
+        if os.path.exists(self.snapshot_path) and os.path.getsize(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                with mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    state = pickle.loads(mapped)
+            for name, collection_state in state['collections'].items():
+                self.database[name]._restore(collection_state)
+        self._replay()
+
+    def _wal_replaced(self):
+        try:
+            return os.stat(self.wal_path).st_ino != os.fstat(self._wal.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _replay(self):
+        """Applies every complete WAL record past our offset."""
+        size = os.fstat(self._wal.fileno()).st_size
+        if size <= self._offset:
+            return
+        self._wal.seek(self._offset)
+        data = self._wal.read(size - self._offset)
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, position)
+            start = position + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                # A record still being written, or a torn write from a crash
+                break
+            collection, operation, args = pickle.loads(payload)
+            self.database[collection]._apply(operation, args)
+            position = start + length
+        self._offset += position
+
+    def catch_up(self):
+        """Brings this process up to date with writes appended by others."""
+        with self._lock:
+            if self._wal_replaced():
+                self._load()
+            else:
+                self._replay()
+
+    # --- Writing -------------------------------------------------------------
+
+    @contextmanager
+    def transaction(self):
+        """Serialises a write across threads and processes."""
+        with self._lock:
+            if self._depth:
+                # Nested inside a write this thread is already making
+                yield
+                return
+            while True:
+                if fcntl is not None:
+                    fcntl.flock(self._wal.fileno(), fcntl.LOCK_EX)
+                if not self._wal_replaced():
+                    break
+                # Another process compacted while we waited for the lock
+                if fcntl is not None:
+                    fcntl.flock(self._wal.fileno(), fcntl.LOCK_UN)
+                self._load()
+            self._depth += 1
+            try:
+                self._replay()
+                self._truncate_torn_tail()
+                yield
+                if self._offset >= self.compact_bytes:
+                    self._compact()
+            finally:
+                self._depth -= 1
+                if fcntl is not None and self._wal is not None:
+                    fcntl.flock(self._wal.fileno(), fcntl.LOCK_UN)
+
+    def _truncate_torn_tail(self):
+        # Only called with the lock held and after a replay, so anything past
+        # our offset is an incomplete record left behind by a crashed writer
+        if os.fstat(self._wal.fileno()).st_size > self._offset:
+            self._wal.truncate(self._offset)
+
+    def append(self, collection, operation, args):
+        """Appends one record; must be called inside transaction()."""
+        payload = pickle.dumps((collection, operation, args), protocol=pickle.HIGHEST_PROTOCOL)
+        self._wal.seek(0, os.SEEK_END)
+        self._wal.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        self._wal.flush()
+        if self.fsync:
+            os.fsync(self._wal.fileno())
+        self._offset = self._wal.tell()
+
+    # --- Compaction ----------------------------------------------------------
+
+    def compact(self):
+        """Folds the WAL into a new snapshot and starts an empty WAL."""
+        with self.transaction():
+            self._compact()
+
+    def _compact(self):
+        state = {'collections': {
+            name: collection._dump() for name, collection in self.database.collections.items()
+        }}
+        temporary = self.snapshot_path + '.tmp'
+        with open(temporary, 'wb') as snapshot:
+            pickle.dump(state, snapshot, protocol=pickle.HIGHEST_PROTOCOL)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temporary, self.snapshot_path)
+
+        # Swap in a fresh WAL; the old one stays locked until we release it,
+        # and other processes reload once they see the new inode
+        temporary = self.wal_path + '.tmp'
+        open(temporary, 'wb').close()
+        os.replace(temporary, self.wal_path)
+        old_wal = self._wal
+        self._wal = open(self.wal_path, 'a+b')
+        self._offset = 0
+        if fcntl is not None:
+            fcntl.flock(self._wal.fileno(), fcntl.LOCK_EX)
+            fcntl.flock(old_wal.fileno(), fcntl.LOCK_UN)
+        old_wal.close()
+
+    def close(self):
+        with self._lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
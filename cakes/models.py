@@ -1,26 +1,52 @@
 # cakes/models.py
 
-from flask_login import UserMixin
 
-class User(UserMixin):
+class User:
     """
     User model for Flask-Login.
-    It takes a user document from MongoDB as input.
+    It takes a user document from MongoDB as input and keeps only the fields
+    the views need (not the password hash), in slots, so cached instances
+    stay small.
     """
+    __slots__ = (
+        '_id', 'email', 'role', 'username', 'first_name', 'last_name',
+        'profile_image', 'is_student', 'student_discount_requested', 'phone',
+        'address', 'city', 'district', 'postal_code', 'newsletter',
+    )
+
     def __init__(self, user_data):
-        self.user_data = user_data
+        self._id = user_data.get('_id')
         self.email = user_data.get('email')
-        self.password = user_data.get('password')
         self.role = user_data.get('role', 'customer')
         self.username = user_data.get('username', '')
         self.first_name = user_data.get('first_name', '')
         self.last_name = user_data.get('last_name', '')
         self.profile_image = user_data.get('profile_image', '')
         self.is_student = user_data.get('is_student', False)
+        self.student_discount_requested = user_data.get('student_discount_requested', False)
+        self.phone = user_data.get('phone', '')
+        self.address = user_data.get('address', '')
+        self.city = user_data.get('city', '')
+        self.district = user_data.get('district', '')
+        self.postal_code = user_data.get('postal_code', '')
+        self.newsletter = user_data.get('newsletter', False)
+
+    # The rest of the interface Flask-Login expects (what UserMixin provides)
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
 
     def get_id(self):
         """
         Required by Flask-Login. Returns a unique ID for the user.
         We use the email address as the unique ID.
         """
-        return str(self.email)
\ No newline at end of file
+        return str(self.email)
+
+    def __eq__(self, other):
+        if isinstance(other, User):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.get_id())
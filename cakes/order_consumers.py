@@ -0,0 +1,200 @@
+# cakes/order_consumers.py
+# Consumers of the order events (see order_events.py): everything an order
+# write sets off happens here, in the background, instead of in the request.
+# Each consumer is idempotent, since an event can be delivered more than once.
+
+from datetime import datetime
+
+from flask_mail import Message
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    from .mock_db import DuplicateKeyError
+
+from . import db
+from .loyalty import apply_order_event
+from .order_events import covers, order_events, recount_coverage
+from .outbox import email_outbox
+from .related import record_order
+
+COUNTERS_ID = 'orders'
+
+
+# --- Customer email ----------------------------------------------------------
+
+@order_events.consumer('confirmation_email', 'order_created')
+def send_order_confirmation(event):
+    """Queues the order confirmation email (keyed by the event, so it is queued once)."""
+    order = db.orders.find_one({'_id': event['order_id']})
+    if order is None:
+        return  # Deleted before we got to it
+    order_id = order.get('order_id')
+    delivery_date_str = order.get('delivery_date')
+    phone_number = order.get('customer_phone')
+    total_amount = order.get('total_amount') or 0
+    product_list_html = "".join([f"<li>{p['name']} - Shs {p['price']:,.0f}</li>" for p in order.get('items', [])])
+    msg = Message(f"FynCakes Order Confirmation - #{order_id}", recipients=[order['customer_email']])
+    msg.html = f"""
+    <div style="font-family: sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
+        <div style="text-align: center; margin-bottom: 30px;">
+            <h1 style="color: #e74c3c;">Thank You for Your Order!</h1>
+            <p style="font-size: 18px; color: #666;">Your order has been received and is being processed.</p>
+        </div>
+
+        <div style="background: #f8f9fa; padding: 20px; border-radius: 10px; margin-bottom: 20px;">
+            <h3 style="color: #2c3e50; margin-top: 0;">Order Details</h3>
+            <p><strong>Order ID:</strong> #{order_id}</p>
+            <p><strong>Delivery Date:</strong> {delivery_date_str}</p>
+            <p><strong>Contact Phone:</strong> {phone_number}</p>
+        </div>
+
+        <div style="margin-bottom: 20px;">
+            <h3 style="color: #2c3e50;">Order Summary</h3>
+            <ul style="list-style: none; padding: 0;">
+                {product_list_html}
+            </ul>
+            <div style="border-top: 2px solid #e74c3c; padding-top: 15px; margin-top: 15px;">
+                <p style="font-size: 20px; font-weight: bold; color: #e74c3c; margin: 0;">
+                    Total Amount: Shs {total_amount:,.0f}
+                </p>
+            </div>
+        </div>
+
+        <div style="background: #e8f5e8; padding: 20px; border-radius: 10px; border-left: 5px solid #28a745;">
+            <h3 style="color: #155724; margin-top: 0;">Next Steps: Payment</h3>
+            <p style="color: #155724; margin-bottom: 10px;">
+                Please send the total amount via Mobile Money to: 
+                <strong style="font-size: 18px;">0758 449 390</strong>
+            </p>
+            <p style="color: #155724; margin: 0;">
+                Use your Order ID <strong>({order_id})</strong> as the payment reference.
+            </p>
+        </div>
+
+        <div style="text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd;">
+            <p style="color: #666; margin: 0;">Thank you for choosing FynCakes!</p>
+            <p style="color: #666; margin: 5px 0 0 0;">We'll notify you once your payment is confirmed.</p>
+        </div>
+    </div>
+    """
+    email_outbox.send(msg, key=f"{event['_id']}:confirmation_email")
+    print(f"✅ Order confirmation email queued for {order['customer_email']}")
+
+
+# --- Loyalty points ----------------------------------------------------------
+
+@order_events.consumer('loyalty', 'order_created', 'order_status_changed', 'order_cancelled', 'order_deleted')
+def update_loyalty(event):
+    """Adds the order's points to the customer's balance, or takes them back (see loyalty.py)."""
+    apply_order_event(event)
+
+
+# --- Related cakes -----------------------------------------------------------
+
+@order_events.consumer('related_cakes', 'order_created')
+def count_bought_together(event):
+    order = db.orders.find_one({'_id': event['order_id']})
+    if order is not None:
+        record_order(db, order)
+
+
+# --- Dashboard counters ------------------------------------------------------
+
+def _first_time(event, consumer):
+    """
+    Records that ``consumer`` applied ``event``; False if it already had.
+    The receipt is written before the effect, so a crash in between loses
+    that one update rather than applying it twice (rebuild_order_counters
+    corrects any drift).
+    """
+    try:
+        db.order_event_receipts.insert_one({'_id': f"{event['_id']}:{consumer}", 'created_at': datetime.now()})
+        return True
+    except DuplicateKeyError:
+        return False
+
+def _counter_changes(event):
+    amount = event.get('total_amount') or 0
+    if event['type'] == 'order_created':
+        return {'total': 1, 'revenue': amount, f"by_status.{event.get('status')}": 1}
+    if event['type'] == 'order_deleted':
+        return {'total': -1, 'revenue': -amount, f"by_status.{event.get('status')}": -1}
+    return {f"by_status.{event.get('previous_status')}": -1, f"by_status.{event.get('status')}": 1}
+
+@order_events.consumer('dashboard_counters', 'order_created', 'order_status_changed', 'order_cancelled', 'order_deleted')
+def update_order_counters(event, attempts=5):
+    """
+    Adds the event to the counters, unless the last rebuild counted it. The
+    $inc only matches the counters revision that was checked, so a rebuild
+    landing in between makes us check again instead of counting twice.
+    """
+    recorded = False
+    for _ in range(attempts):
+        counters = db.order_counters.find_one({'_id': COUNTERS_ID})
+        if counters is None:
+            return  # Counted when the counters are first read and built
+        if 'covered_orders' not in counters:
+            # Counters from before covered_orders: rebuilding them counts this change
+            rebuild_order_counters()
+            break
+        if covers(counters['covered_orders'], event):
+            break
+        if not recorded:
+            if not _first_time(event, 'dashboard_counters'):
+                return
+            recorded = True
+        result = db.order_counters.update_one({'_id': COUNTERS_ID, 'revision': counters.get('revision')},
+                                              {'$inc': {**_counter_changes(event), 'revision': 1}})
+        if result.modified_count:
+            return
+    else:
+        if recorded:
+            db.order_event_receipts.delete_one({'_id': f"{event['_id']}:dashboard_counters"})
+        raise RuntimeError("Order counters kept changing")
+    if recorded:
+        db.order_event_receipts.delete_one({'_id': f"{event['_id']}:dashboard_counters"})
+
+def rebuild_order_counters(attempts=5):
+    """
+    Recounts the order counters from the orders collection. The counters
+    remember which order changes the recount read (covered_orders), so the
+    events for those are skipped afterwards while later ones still count.
+    They are only replaced if no event was counted while the orders were
+    being read; otherwise the recount starts over.
+    """
+    for _ in range(attempts):
+        current = db.order_counters.find_one({'_id': COUNTERS_ID}, {'revision': 1})
+        counters = {'total': 0, 'revenue': 0, 'by_status': {}}
+        seen = {}
+        # Demo orders aren't counted
+        for order in db.orders.find({'sample': {'$ne': True}}, {'status': 1, 'total_amount': 1, 'last_event_at': 1}):
+            seen[str(order['_id'])] = order.get('last_event_at')
+            status = str(order.get('status'))
+            counters['total'] += 1
+            counters['revenue'] += order.get('total_amount') or 0
+            counters['by_status'][status] = counters['by_status'].get(status, 0) + 1
+        counters['covered_orders'] = recount_coverage(seen)
+        counters['rebuilt_at'] = datetime.now()
+        if current is None:
+            try:
+                db.order_counters.insert_one({'_id': COUNTERS_ID, **counters, 'revision': 0})
+            except DuplicateKeyError:
+                continue
+        else:
+            result = db.order_counters.update_one({'_id': COUNTERS_ID, 'revision': current.get('revision')},
+                                                  {'$set': counters, '$inc': {'revision': 1}})
+            if not result.modified_count:
+                continue
+        return dict(counters, _id=COUNTERS_ID)
+    raise RuntimeError("Order counters kept changing during the rebuild")
+
+def order_counters():
+    """
+    Returns {'total', 'revenue', 'by_status': {status: count}} for the admin
+    dashboards without counting the orders collection on every view.
+    """
+    counters = db.order_counters.find_one({'_id': COUNTERS_ID}, {'covered_orders': 0})
+    if counters is None:
+        counters = rebuild_order_counters()
+    return counters
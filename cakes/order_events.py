@@ -0,0 +1,287 @@
+# cakes/order_events.py
+# Transactional outbox for orders. Every order write carries its event
+# ('order_created', 'order_status_changed', 'order_cancelled') inside the
+# same single-document write, so the event exists exactly when the change
+# does. A background processor then relays events from the orders into the
+# order_events log and runs the registered consumers (emails, loyalty
+# points, dashboard counters, ...) on each one, retrying failures.
+
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    from .mock_db import DuplicateKeyError
+
+from . import db
+
+EVENT_TYPES = ('order_created', 'order_status_changed', 'order_cancelled', 'order_deleted')
+
+
+# --- Writing orders with their events ----------------------------------------
+
+def _event(event_type, **fields):
+    return {'_id': uuid.uuid4().hex, 'type': event_type, 'at': datetime.now(), **fields}
+
+def insert_order(order):
+    """Inserts a new order together with its 'order_created' event (one write)."""
+    event = _event('order_created', status=order.get('status'), total_amount=order.get('total_amount') or 0)
+    order['pending_events'] = [event]
+    order['has_pending_events'] = True
+    order['last_event_at'] = event['at']
+    result = db.orders.insert_one(order)
+    order_events.notify()
+    return result
+
+def change_order_status(order, status, fields=None):
+    """
+    Sets ``order``'s status (plus any other ``fields``) and records an
+    'order_status_changed' or 'order_cancelled' event in the same write. The
+    update only applies while the order still has the status it was read
+    with, so the event's previous status is always right; returns the
+    UpdateResult (modified_count 0 if the order changed in the meantime).
+    """
+    previous = order.get('status')
+    if order.get('sample'):
+        # Demo orders never had an event, so their changes don't get one either
+        return db.orders.update_one({'_id': order['_id'], 'status': previous},
+                                    {'$set': {**(fields or {}), 'status': status}})
+    event_type = 'order_cancelled' if status == 'cancelled' else 'order_status_changed'
+    event = _event(event_type, status=status, previous_status=previous,
+                   total_amount=order.get('total_amount') or 0)
+    result = db.orders.update_one(
+        {'_id': order['_id'], 'status': previous},
+        {'$set': {**(fields or {}), 'status': status, 'has_pending_events': True, 'last_event_at': event['at']},
+         '$push': {'pending_events': event}},
+    )
+    if result.modified_count:
+        order_events.notify()
+    return result
+
+def delete_order(order):
+    """
+    Deletes ``order`` and logs an 'order_deleted' event. With the order gone
+    there is no document to carry the event, so it is written straight to the
+    log after the delete. A tombstone in deleted_orders, written first,
+    tells recounts that no longer find the order that its events up to the
+    delete are accounted for (see recount_coverage).
+    """
+    if order.get('sample'):
+        return db.orders.delete_one({'_id': order['_id']})
+    event = _event('order_deleted', status=order.get('status'), total_amount=order.get('total_amount') or 0)
+    db.deleted_orders.update_one({'_id': order['_id']},
+                                 {'$set': {'customer_email': order.get('customer_email'), 'at': event['at']}},
+                                 upsert=True)
+    result = db.orders.delete_one({'_id': order['_id']})
+    if result.deleted_count:
+        order_events.log(order, event)
+        order_events.notify()
+    return result
+
+
+# --- Recounts ----------------------------------------------------------------
+# Totals kept up to date from the events (loyalty balances, the dashboard
+# counters) can also be recounted from the orders. A recount records which
+# order changes it read, so the events for those are skipped afterwards
+# while later ones still apply.
+
+def oldest_undelivered_event_at():
+    """The time of the oldest event not yet handled (None if there is none)."""
+    oldest = None
+    # Orders first: the relay logs an event before pulling it from its order,
+    # so an event moving between the two is always found in one of them
+    for order in db.orders.find({'has_pending_events': True}, {'pending_events': 1}):
+        for event in order.get('pending_events') or []:
+            if oldest is None or event['at'] < oldest:
+                oldest = event['at']
+    for event in db.order_events.find({'state': {'$in': ['pending', 'running']}}, {'at': 1}).sort('at', 1).limit(1):
+        if oldest is None or event['at'] < oldest:
+            oldest = event['at']
+    return oldest
+
+def recount_coverage(seen, deleted_query=None):
+    """
+    What a recount covers: order id -> time of the last change it counted.
+    ``seen`` maps the orders it read to their last_event_at; call this after
+    reading them. Orders deleted before the read are covered up to their
+    delete, from the tombstones matching ``deleted_query``. Only entries from
+    the oldest undelivered event on are kept, since every earlier event has
+    been handled already, so the map stays small.
+    """
+    fence = oldest_undelivered_event_at()
+    if fence is None:
+        return {}
+    coverage = {order_id: at for order_id, at in seen.items() if at is not None and at >= fence}
+    for tombstone in db.deleted_orders.find({**(deleted_query or {}), 'at': {'$gte': fence}}, {'at': 1}):
+        if str(tombstone['_id']) not in seen:
+            coverage[str(tombstone['_id'])] = tombstone['at']
+    return coverage
+
+def covers(coverage, event):
+    """Whether the recount with this ``coverage`` already counted ``event``."""
+    seen_until = coverage.get(str(event.get('order_id')))
+    return seen_until is not None and event['at'] <= seen_until
+
+
+# --- Processing --------------------------------------------------------------
+
+class OrderEventProcessor:
+    """
+    Relays pending events from orders into the order_events collection and
+    runs the consumers registered for each event type.
+
+    Consumers must be idempotent: an event is delivered at least once. Each
+    event records the consumers that have handled it, so a retry only re-runs
+    the ones that failed. Like the email outbox, events are claimed with a
+    conditional update, so several worker processes can share the work.
+    """
+    def __init__(self, threads=1, batch_size=50, max_attempts=10, base_delay=10,
+                 max_delay=1800, poll_interval=5, claim_timeout=300):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.consumers = {}  # event type -> [(name, handler)]
+        self.app = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        app.before_request(self._ensure_started)
+
+    def consumer(self, name, *event_types):
+        """Decorator registering ``handler(event)`` under ``name`` for the given event types."""
+        def register(handler):
+            for event_type in event_types:
+                self.consumers.setdefault(event_type, []).append((name, handler))
+            return handler
+        return register
+
+    def notify(self):
+        """Wakes this process's processor so a new event is handled right away."""
+        self._ensure_started()
+        self._wake.set()
+
+    # --- Relay ---------------------------------------------------------------
+
+    def log(self, order, event):
+        """Adds an event to the order_events log; logging the same event twice is a no-op."""
+        try:
+            db.order_events.insert_one({
+                **event,
+                'order_id': order['_id'],
+                'customer_email': order.get('customer_email'),
+                'state': 'pending',
+                'handled': [],
+                'attempts': 0,
+                'next_attempt_at': datetime.now(),
+            })
+        except DuplicateKeyError:
+            pass
+
+    def relay(self):
+        """Moves pending events from the orders into the log. Returns the number relayed."""
+        relayed = 0
+        for order in db.orders.find({'has_pending_events': True}).limit(self.batch_size):
+            events = order.get('pending_events') or []
+            for event in events:
+                self.log(order, event)
+            ids = [event['_id'] for event in events]
+            db.orders.update_one({'_id': order['_id']}, {'$pull': {'pending_events': {'_id': {'$in': ids}}}})
+            # Clears the flag unless another event was added in the meantime
+            db.orders.update_one({'_id': order['_id'], 'pending_events': []},
+                                 {'$unset': {'has_pending_events': '', 'pending_events': ''}})
+            relayed += len(events)
+        return relayed
+
+    # --- Dispatch ------------------------------------------------------------
+
+    def _claim(self, limit):
+        now = datetime.now()
+        due = {'$or': [
+            {'state': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'state': 'running', 'claimed_until': {'$lt': now}},
+        ]}
+        claimed = []
+        for candidate in db.order_events.find(due).sort('at', 1).limit(limit):
+            result = db.order_events.update_one(
+                {'_id': candidate['_id'], 'state': candidate['state'],
+                 'attempts': candidate['attempts'], 'claimed_until': candidate.get('claimed_until')},
+                {'$set': {'state': 'running',
+                          'claimed_until': now + timedelta(seconds=self.claim_timeout)}},
+            )
+            if result.modified_count:
+                claimed.append(candidate)
+        return claimed
+
+    def dispatch(self, event):
+        """Runs the consumers that haven't handled ``event`` yet; raises the first failure."""
+        handled = set(event.get('handled', []))
+        for name, handler in self.consumers.get(event['type'], []):
+            if name in handled:
+                continue
+            handler(event)
+            db.order_events.update_one({'_id': event['_id']}, {'$addToSet': {'handled': name}})
+
+    def process(self):
+        """Relays and handles one batch of events. Returns whether there was anything to do."""
+        relayed = self.relay()
+        batch = self._claim(self.batch_size)
+        for event in batch:
+            try:
+                self.dispatch(event)
+            except Exception as e:
+                attempts = event['attempts'] + 1
+                update = {'attempts': attempts, 'last_error': str(e)}
+                if attempts >= self.max_attempts:
+                    update['state'] = 'failed'
+                    print(f"❌ Giving up on order event {event['_id']} ({event['type']}): {e}")
+                else:
+                    delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+                    update['state'] = 'pending'
+                    update['next_attempt_at'] = datetime.now() + timedelta(seconds=delay)
+                db.order_events.update_one({'_id': event['_id']}, {'$set': update, '$unset': {'claimed_until': ''}})
+            else:
+                db.order_events.update_one(
+                    {'_id': event['_id']},
+                    {'$set': {'state': 'done', 'done_at': datetime.now()},
+                     '$unset': {'claimed_until': '', 'last_error': ''}},
+                )
+        return bool(relayed or batch)
+
+    def _ensure_started(self):
+        if self.app is None or self.threads <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            for number in range(self.threads):
+                threading.Thread(target=self._run, name=f'order-events-{number}', daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            try:
+                with self.app.app_context():
+                    busy = self.process()
+            except Exception as e:
+                print(f"⚠️  Order event processor error: {e}")
+                busy = False
+            if not busy:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+order_events = OrderEventProcessor(
+    threads=int(os.environ.get('ORDER_EVENT_THREADS', 1)),
+)
@@ -0,0 +1,101 @@
+# cakes/order_ids.py
+# Human-readable order IDs (FYN-1000001, FYN-1000002, ...) from a counter in
+# the counters collection. Each worker reserves a block of numbers with one
+# atomic $inc and hands them out from memory, so placing an order normally
+# costs no extra database round-trip, and IDs never collide (orders.order_id
+# also has a unique index).
+
+import os
+import threading
+
+try:
+    from pymongo import ReturnDocument
+    RETURN_AFTER = ReturnDocument.AFTER
+except ImportError:
+    RETURN_AFTER = True
+
+from . import db
+
+ORDER_ID_PREFIX = 'FYN-'
+# Numbering starts above the old random FYN-1000..FYN-9999 IDs; seven digits
+# keep the IDs in numeric order when sorted as strings
+FIRST_ORDER_NUMBER = 1000000
+ORDER_NUMBER_DIGITS = 7
+
+
+class BlockAllocator:
+    """
+    Hands out increasing numbers from the counter document ``name``,
+    reserving ``block_size`` at a time. Numbers are unique across processes;
+    within a process they increase, but workers draw from different blocks,
+    so IDs are only roughly in creation order across workers. Numbers left in
+    a block when a worker exits are skipped.
+    """
+    def __init__(self, name, block_size=20, start=0):
+        self.name = name
+        self.block_size = block_size
+        self.start = start
+        self._lock = threading.Lock()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # A forked child must not hand out its parent's reserved numbers
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._next = 1
+        self._end = 0
+
+    def _reserve(self):
+        counter = db.counters.find_one_and_update(
+            {'_id': self.name},
+            {'$inc': {'value': self.block_size}, '$setOnInsert': {'start': self.start}},
+            upsert=True,
+            return_document=RETURN_AFTER,
+        )
+        self._end = counter['value']
+        self._next = self._end - self.block_size + 1
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            if self._next > self._end:
+                self._reserve()
+            number = self._next
+            self._next += 1
+        return self.start + number
+
+
+order_numbers = BlockAllocator('order_id', block_size=int(os.environ.get('ORDER_ID_BLOCK_SIZE', 20)),
+                               start=FIRST_ORDER_NUMBER)
+
+
+def next_order_id():
+    """Allocates a new, unique order ID such as 'FYN-1000001'."""
+    return f"{ORDER_ID_PREFIX}{order_numbers.next():0{ORDER_NUMBER_DIGITS}d}"
+
+
+def renumber_duplicate_order_ids():
+    """
+    Gives every order that shares its order_id with an older order a new ID,
+    keeping the old one in legacy_order_id. The random IDs used before the
+    counter could repeat, and any repeats block the unique index on
+    orders.order_id. Returns (old ID, new ID) pairs for the renumbered orders.
+    """
+    duplicates = db.orders.aggregate([
+        {'$match': {'order_id': {'$ne': None}}},
+        {'$sort': {'created_at': 1, '_id': 1}},
+        {'$group': {'_id': '$order_id', 'orders': {'$push': '$_id'}, 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gt': 1}}},
+    ])
+    renumbered = []
+    for group in duplicates:
+        # The oldest order keeps the ID its customer was given first
+        for order_id in group['orders'][1:]:
+            new_id = next_order_id()
+            result = db.orders.update_one({'_id': order_id, 'order_id': group['_id']},
+                                          {'$set': {'order_id': new_id, 'legacy_order_id': group['_id']}})
+            if result.modified_count:
+                renumbered.append((group['_id'], new_id))
+    return renumbered
@@ -0,0 +1,198 @@
+# cakes/outbox.py
+# Outgoing email goes through a durable outbox instead of being sent inside
+# the request: views store the message in the email_outbox collection and
+# return at once, and a small pool of sender threads in each worker process
+# delivers queued mail in batches over one SMTP connection, retrying
+# failures with exponential backoff.
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+from flask_mail import Message
+
+try:
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    from .mock_db import DuplicateKeyError
+
+from . import db, mail
+
+# Message attributes stored in the outbox and used to rebuild it for sending
+MESSAGE_FIELDS = ('subject', 'recipients', 'body', 'html', 'sender', 'cc', 'bcc', 'reply_to')
+STATUSES = ('pending', 'sending', 'sent', 'failed')
+
+
+class EmailOutbox:
+    """
+    Durable email queue plus the per-process sender pool that drains it.
+
+    A message is claimed by flipping its status from 'pending' to 'sending'
+    with a conditional update, so workers in different processes never send
+    the same message twice. A claim expires after ``claim_timeout`` seconds,
+    which hands messages held by a crashed worker back to the queue. After
+    ``max_attempts`` failures a message is marked 'failed' and left for an
+    admin to look at.
+    """
+    def __init__(self, threads=2, batch_size=20, max_attempts=8, base_delay=30,
+                 max_delay=3600, poll_interval=5, claim_timeout=300):
+        self.threads = threads
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.app = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        # Sender threads don't survive a fork, so each worker starts its own
+        # pool on its first request (or first queued message)
+        app.before_request(self._ensure_started)
+
+    # --- Queueing ------------------------------------------------------------
+
+    def send(self, message, key=None):
+        """
+        Queues a flask_mail Message for delivery and returns its outbox id.
+        Passing a ``key`` makes the call idempotent: a message already queued
+        under the same key is not queued again.
+        """
+        document = {field: getattr(message, field, None) for field in MESSAGE_FIELDS}
+        if isinstance(document['sender'], tuple):
+            document['sender'] = list(document['sender'])
+        now = datetime.now()
+        document.update({
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now,
+            'created_at': now,
+        })
+        if key is not None:
+            document['_id'] = key
+        try:
+            inserted_id = db.email_outbox.insert_one(document).inserted_id
+        except DuplicateKeyError:
+            if key is None:
+                raise
+            return key
+        self._ensure_started()
+        self._wake.set()
+        return inserted_id
+
+    def queue_depth(self):
+        """Returns the number of outbox messages in each status, e.g. {'pending': 3, ...}."""
+        depth = dict.fromkeys(STATUSES, 0)
+        for row in db.email_outbox.aggregate([{'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            depth[row['_id']] = row['count']
+        oldest = next(iter(db.email_outbox.find({'status': 'pending'}).sort('created_at', 1).limit(1)), None)
+        depth['oldest_pending_at'] = oldest['created_at'] if oldest else None
+        return depth
+
+    # --- Sending -------------------------------------------------------------
+
+    def _ensure_started(self):
+        if self.app is None or self.threads <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._wake = threading.Event()
+            for number in range(self.threads):
+                threading.Thread(target=self._run, name=f'email-sender-{number}', daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            try:
+                with self.app.app_context():
+                    sent_any = self._drain()
+            except Exception as e:
+                print(f"⚠️  Email sender error: {e}")
+                sent_any = False
+            if not sent_any:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+    def _claim(self, limit):
+        now = datetime.now()
+        due = {'$or': [
+            {'status': 'pending', 'next_attempt_at': {'$lte': now}},
+            {'status': 'sending', 'claimed_until': {'$lt': now}},
+        ]}
+        claimed = []
+        for candidate in db.email_outbox.find(due).sort('next_attempt_at', 1).limit(limit):
+            result = db.email_outbox.update_one(
+                # Only wins if nobody else claimed (or retried) it since we read it
+                {'_id': candidate['_id'], 'status': candidate['status'],
+                 'attempts': candidate.get('attempts', 0), 'claimed_until': candidate.get('claimed_until')},
+                {'$set': {'status': 'sending', 'claimed_until': now + timedelta(seconds=self.claim_timeout)}},
+            )
+            if result.modified_count:
+                claimed.append(candidate)
+        return claimed
+
+    def _drain(self):
+        """Sends due messages in batches over one SMTP connection; returns whether any were due."""
+        batch = self._claim(self.batch_size)
+        if not batch:
+            return False
+        try:
+            connection = mail.connect()
+            connection.__enter__()
+        except Exception as e:
+            # Couldn't reach the mail server: every message in the batch waits and retries
+            for document in batch:
+                self._failed(document, e)
+            return True
+        try:
+            while batch:
+                for document in batch:
+                    try:
+                        connection.send(self._message(document))
+                    except Exception as e:
+                        self._failed(document, e)
+                    else:
+                        db.email_outbox.update_one(
+                            {'_id': document['_id']},
+                            {'$set': {'status': 'sent', 'sent_at': datetime.now()},
+                             '$inc': {'attempts': 1}, '$unset': {'claimed_until': '', 'last_error': ''}},
+                        )
+                # Keep the connection while there is more to send
+                batch = self._claim(self.batch_size)
+        finally:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return True
+
+    def _message(self, document):
+        fields = {field: document.get(field) for field in MESSAGE_FIELDS if document.get(field) is not None}
+        if isinstance(fields.get('sender'), list):
+            fields['sender'] = tuple(fields['sender'])
+        return Message(**fields)
+
+    def _failed(self, document, error):
+        attempts = document.get('attempts', 0) + 1
+        update = {'attempts': attempts, 'last_error': str(error)}
+        if attempts >= self.max_attempts:
+            update['status'] = 'failed'
+            print(f"❌ Giving up on email {document['_id']} to {document.get('recipients')} after {attempts} attempts: {error}")
+        else:
+            delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+            update['status'] = 'pending'
+            update['next_attempt_at'] = datetime.now() + timedelta(seconds=delay)
+        db.email_outbox.update_one({'_id': document['_id']}, {'$set': update, '$unset': {'claimed_until': ''}})
+
+
+email_outbox = EmailOutbox(
+    threads=int(os.environ.get('EMAIL_SENDER_THREADS', 2)),
+    batch_size=int(os.environ.get('EMAIL_BATCH_SIZE', 20)),
+    max_attempts=int(os.environ.get('EMAIL_MAX_ATTEMPTS', 8)),
+)
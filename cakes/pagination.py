@@ -0,0 +1,125 @@
+# cakes/pagination.py
+# Keyset ("seek") pagination: instead of skip(n), each page continues from an
+# opaque cursor holding the sort key of the last document shown, so fetching
+# page 50 costs the same index seek as page 1 and rows don't shift when
+# documents are inserted in between.
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+try:
+    from bson.objectid import ObjectId
+except ImportError:
+    ObjectId = None
+
+from .search import TEXT_SCORE
+
+
+# --- Cursor encoding ---------------------------------------------------------
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'$date': value.isoformat()}
+    if ObjectId is not None and isinstance(value, ObjectId):
+        return {'$oid': str(value)}
+    return value
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if '$date' in value:
+            return datetime.fromisoformat(value['$date'])
+        if '$oid' in value and ObjectId is not None:
+            return ObjectId(value['$oid'])
+    return value
+
+def encode_cursor(payload):
+    """Serialises a cursor payload into a URL-safe token."""
+    data = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def decode_cursor(token):
+    """Parses a token made by encode_cursor; raises ValueError if it is malformed."""
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Invalid pagination cursor: {e}")
+    if not isinstance(payload, dict):
+        raise ValueError("Invalid pagination cursor")
+    return payload
+
+
+# --- Paging ------------------------------------------------------------------
+
+def _sort_value(document, field):
+    value = document
+    for part in field.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+def _after_filter(query, sort, values):
+    """Narrows ``query`` to the documents strictly after ``values`` in ``sort`` order."""
+    clauses = []
+    for position, (field, direction) in enumerate(sort):
+        clause = {previous: value for (previous, _), value in zip(sort[:position], values)}
+        clause[field] = {'$gt' if direction > 0 else '$lt': values[position]}
+        clauses.append(clause)
+    # Merge into the top level where possible so the query can still use its indexes
+    if len(clauses) == 1 and not set(clauses[0]) & set(query):
+        return {**query, **clauses[0]}
+    if '$or' not in query:
+        return {**query, '$or': clauses}
+    return {'$and': [query, {'$or': clauses}]}
+
+def page_sort(sort):
+    """``sort`` with _id appended as the tie-breaker, so the order is total."""
+    sort = list(sort)
+    if not any(field == '_id' for field, _ in sort):
+        sort.append(('_id', 1))
+    return sort
+
+def next_page_cursor(query, sort, documents, limit, offset=0):
+    """
+    The cursor for the page after ``documents`` (fetched with limit + 1 in
+    ``page_sort(sort)`` order, starting ``offset`` into a $text listing), or
+    None when there is nothing more to show.
+    """
+    if len(documents) <= limit:
+        return None
+    if '$text' in query:
+        return encode_cursor({'offset': offset + limit})
+    last = documents[limit - 1]
+    return encode_cursor({'key': [_encode_value(_sort_value(last, field)) for field, _ in page_sort(sort)]})
+
+def keyset_page(collection, query, sort, limit, after=None, include_total=False):
+    """
+    Fetches one page of ``collection.find(query)`` in ``sort`` order (a list
+    of (field, direction); _id is added as the tie-breaker so the order is
+    total). Returns (documents, next cursor or None, total or None); the
+    total is only counted when ``include_total`` is set, e.g. on page one.
+
+    $text queries are ordered by relevance, which has no stored key to seek
+    on, so their cursor carries an offset instead.
+    """
+    sort = page_sort(sort)
+    state = decode_cursor(after) if after else {}
+
+    offset = 0
+    if '$text' in query:
+        offset = int(state.get('offset', 0))
+        cursor = collection.find(query, {'score': TEXT_SCORE}).sort([('score', TEXT_SCORE)] + sort)
+        documents = list(cursor.skip(offset).limit(limit + 1))
+    else:
+        page_query = query
+        if 'key' in state:
+            values = [_decode_value(value) for value in state['key']]
+            if len(values) != len(sort):
+                raise ValueError("Pagination cursor does not match this listing")
+            page_query = _after_filter(query, sort, values)
+        documents = list(collection.find(page_query).sort(sort).limit(limit + 1))
+
+    next_cursor = next_page_cursor(query, sort, documents, limit, offset)
+    total = collection.count_documents(query) if include_total else None
+    return documents[:limit], next_cursor, total
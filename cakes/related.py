@@ -0,0 +1,199 @@
+# cakes/related.py
+# Precomputed "you may also like" recommendations for the cake page.
+# Every cake's best matches are stored in the related_cakes collection under
+# the cake's id, so the page reads them with one _id lookup. They are built
+# in bulk by `flask rebuild-related`, and the admin cake views and order
+# placement refresh just the entries a change can affect.
+
+import functools
+import math
+from datetime import datetime
+
+RELATED_LIMIT = 3
+# Cake fields stored with each recommendation (what the cake page shows)
+SUMMARY_FIELDS = ('name', 'image', 'price', 'category', 'description')
+
+
+# --- Scoring -----------------------------------------------------------------
+
+def _terms(values):
+    if isinstance(values, str):
+        values = values.split(',')
+    return {value.strip().lower() for value in values or [] if isinstance(value, str) and value.strip()}
+
+def _overlap(first, second):
+    union = first | second
+    return len(first & second) / len(union) if union else 0.0
+
+def similarity(cake, other, bought_together=0):
+    """
+    How good a recommendation ``other`` is on ``cake``'s page: same category,
+    shared ingredients, a similar allergen profile, a similar price and how
+    many orders contained both.
+    """
+    score = 0.0
+    if cake.get('category') and cake.get('category') == other.get('category'):
+        score += 3.0
+    score += 4.0 * _overlap(_terms(cake.get('ingredients')), _terms(other.get('ingredients')))
+    score += 1.0 * _overlap(_terms(cake.get('allergens')), _terms(other.get('allergens')))
+    prices = [cake.get('price'), other.get('price')]
+    if all(isinstance(price, (int, float)) and price > 0 for price in prices):
+        score += 0.5 * min(prices) / max(prices)
+    score += 2.0 * math.log1p(bought_together)
+    return round(score, 4)
+
+def _summary(cake, score):
+    summary = {field: cake.get(field) for field in SUMMARY_FIELDS}
+    summary['_id'] = str(cake['_id'])
+    summary['score'] = score
+    return summary
+
+def _rank(candidates):
+    # Highest score first; name as a stable tie-breaker
+    return sorted(candidates, key=lambda item: (-item['score'], item.get('name') or ''))[:RELATED_LIMIT]
+
+def _compute(cake, catalog, bought_together):
+    cake_id = str(cake['_id'])
+    return _rank(_summary(other, similarity(cake, other, bought_together.get(str(other['_id']), 0)))
+                 for other in catalog if str(other['_id']) != cake_id)
+
+
+# --- Maintenance -------------------------------------------------------------
+
+def _best_effort(function):
+    """Recommendations are an extra: a failure to refresh them is logged, never raised to the request."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            print(f"Error refreshing related cakes ({function.__name__}): {e}")
+            return None
+    return wrapper
+
+def _order_cake_ids(order, ids_by_name, known_ids):
+    """The ids of the catalog cakes in an order (items carry an id when the cart had one, else just the name)."""
+    ids = set()
+    for item in order.get('items') or order.get('products') or []:
+        if not isinstance(item, dict):
+            continue
+        item_id = item.get('cake_id') or item.get('id') or item.get('_id')
+        if item_id is not None and str(item_id) in known_ids:
+            ids.add(str(item_id))
+        elif item.get('name') in ids_by_name:
+            ids.add(ids_by_name[item['name']])
+    return ids
+
+def _save(db, cake_id, related, bought_together=None):
+    fields = {'related': related, 'updated_at': datetime.now()}
+    if bought_together is not None:
+        fields['bought_together'] = bought_together
+    db.related_cakes.update_one({'_id': cake_id}, {'$set': fields}, upsert=True)
+
+def rebuild_related(db):
+    """Recomputes every cake's recommendations, including bought-together counts from all orders. Returns the number of cakes."""
+    catalog = list(db.cakes.find({}))
+    ids_by_name = {cake.get('name'): str(cake['_id']) for cake in catalog}
+    pairs = {str(cake['_id']): {} for cake in catalog}
+    for order in db.orders.find({}, {'items': 1, 'products': 1}):
+        cake_ids = _order_cake_ids(order, ids_by_name, pairs)
+        for cake_id in cake_ids:
+            for other_id in cake_ids - {cake_id}:
+                pairs[cake_id][other_id] = pairs[cake_id].get(other_id, 0) + 1
+    for cake in catalog:
+        cake_id = str(cake['_id'])
+        _save(db, cake_id, _compute(cake, catalog, pairs[cake_id]), pairs[cake_id])
+    db.related_cakes.delete_many({'_id': {'$nin': list(pairs)}})
+    return len(catalog)
+
+def related_cakes_for(db, cake):
+    """
+    Returns the recommendations for ``cake`` (summaries of up to
+    RELATED_LIMIT cakes). Normally a single _id lookup; a cake added since
+    the last rebuild gets its entry computed and stored here.
+    """
+    entry = db.related_cakes.find_one({'_id': str(cake['_id'])})
+    if entry is not None and 'related' in entry:
+        return entry['related']
+    bought_together = (entry or {}).get('bought_together', {})
+    related = _compute(cake, list(db.cakes.find({})), bought_together)
+    _save(db, str(cake['_id']), related)
+    return related
+
+@_best_effort
+def refresh_cake(db, cake_id):
+    """
+    Call after adding or editing a cake. Recomputes its own entry, then
+    re-scores it on every other cake's list: an entry that held it is
+    recomputed (its score may have dropped), any other only takes it in if it
+    now beats that entry's weakest recommendation.
+    """
+    catalog = list(db.cakes.find({}))
+    cakes_by_id = {str(cake['_id']): cake for cake in catalog}
+    cake_id = str(cake_id)
+    cake = cakes_by_id.get(cake_id)
+    if cake is None:
+        return
+    entries = {entry['_id']: entry for entry in db.related_cakes.find({})}
+    own = entries.get(cake_id, {})
+    _save(db, cake_id, _compute(cake, catalog, own.get('bought_together', {})))
+
+    for other_id, entry in entries.items():
+        other = cakes_by_id.get(other_id)
+        if other_id == cake_id or other is None or 'related' not in entry:
+            continue
+        bought_together = entry.get('bought_together', {})
+        if any(item['_id'] == cake_id for item in entry['related']):
+            _save(db, other_id, _compute(other, catalog, bought_together))
+            continue
+        score = similarity(other, cake, bought_together.get(cake_id, 0))
+        related = _rank(entry['related'] + [_summary(cake, score)])
+        if any(item['_id'] == cake_id for item in related):
+            _save(db, other_id, related)
+
+@_best_effort
+def remove_cake(db, cake_id):
+    """Call after deleting a cake: drops its entry and recomputes the lists that recommended it."""
+    cake_id = str(cake_id)
+    db.related_cakes.delete_one({'_id': cake_id})
+    affected = [entry for entry in db.related_cakes.find({})
+                if any(item['_id'] == cake_id for item in entry.get('related', []))]
+    if not affected:
+        return
+    catalog = list(db.cakes.find({}))
+    cakes_by_id = {str(cake['_id']): cake for cake in catalog}
+    for entry in affected:
+        other = cakes_by_id.get(entry['_id'])
+        if other is not None:
+            _save(db, entry['_id'], _compute(other, catalog, entry.get('bought_together', {})))
+
+@_best_effort
+def record_order(db, order):
+    """
+    Call after an order is placed: counts each pair of cakes in it as bought
+    together and lets each take the other into its list. Scores only go up,
+    so no entry needs recomputing from scratch.
+    """
+    names = [item.get('name') for item in order.get('items') or [] if isinstance(item, dict)]
+    cakes = list(db.cakes.find({'name': {'$in': [name for name in names if name]}}))
+    ids_by_name = {cake.get('name'): str(cake['_id']) for cake in cakes}
+    cakes_by_id = {str(cake['_id']): cake for cake in cakes}
+    cake_ids = _order_cake_ids(order, ids_by_name, cakes_by_id)
+    if len(cake_ids) < 2:
+        return
+    for cake_id in cake_ids:
+        others = cake_ids - {cake_id}
+        db.related_cakes.update_one(
+            {'_id': cake_id},
+            {'$inc': {f"bought_together.{other_id}": 1 for other_id in others}},
+            upsert=True,
+        )
+        entry = db.related_cakes.find_one({'_id': cake_id})
+        if 'related' not in entry:
+            continue  # Computed in full on the cake's next page view
+        bought_together = entry.get('bought_together', {})
+        related = [item for item in entry['related'] if item['_id'] not in others]
+        related += [_summary(cakes_by_id[other_id], similarity(cakes_by_id[cake_id], cakes_by_id[other_id],
+                                                               bought_together.get(other_id, 0)))
+                    for other_id in others]
+        _save(db, cake_id, _rank(related))
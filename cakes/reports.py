@@ -0,0 +1,85 @@
+# cakes/reports.py
+# Server-side sales charts for the admin dashboard.
+# matplotlib is only imported the first time a chart is drawn, and drawing
+# happens in a small thread pool with the finished images cached, so neither
+# worker start-up nor ordinary requests pay for the plotting library.
+
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+CHART_TTL = 300  # seconds a rendered chart is reused
+IMAGE_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+
+_executor = None
+_cache = {}
+_lock = threading.Lock()
+
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='report-renderer')
+    return _executor
+
+
+def daily_sales(db, days):
+    """Returns [(YYYY-MM-DD, total sales)] for the last ``days`` days, oldest first."""
+    start = (datetime.now() - timedelta(days=days - 1)).date()
+    totals = {(start + timedelta(days=offset)).isoformat(): 0 for offset in range(days)}
+    # created_at is stored as a 'YYYY-MM-DD HH:MM:SS' string
+    for order in db.orders.find({'created_at': {'$gte': start.isoformat()}}):
+        created_at = order.get('created_at')
+        day = created_at.date().isoformat() if isinstance(created_at, datetime) else str(created_at)[:10]
+        if day in totals:
+            totals[day] += order.get('total_amount') or 0
+    return list(totals.items())
+
+
+def _render_sales_chart(series, image_format):
+    # Imported here so only processes that actually draw a chart load matplotlib.
+    # The object-oriented Figure API keeps no global pyplot state, so
+    # renders in different threads don't interfere.
+    from matplotlib.figure import Figure
+    from matplotlib.ticker import MaxNLocator
+
+    labels = [day[5:] for day, _ in series]
+    values = [total for _, total in series]
+    figure = Figure(figsize=(8, 3), dpi=100)
+    axes = figure.add_subplot()
+    axes.bar(labels, values, color='#e75480')
+    axes.set_title('Daily sales (Shs)')
+    axes.xaxis.set_major_locator(MaxNLocator(10))
+    axes.yaxis.set_major_formatter(lambda value, _: f"{value:,.0f}")
+    axes.spines[['top', 'right']].set_visible(False)
+    figure.tight_layout()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def sales_chart(db, days=30, image_format='png'):
+    """
+    Returns the daily sales chart as PNG/SVG bytes. Concurrent requests for
+    the same chart share a single render, and the result is reused for
+    CHART_TTL seconds.
+    """
+    key = ('sales', days, image_format)
+    cached = _cache.get(key)
+    if cached is None or cached[0] < time.monotonic():
+        series = daily_sales(db, days)
+        with _lock:
+            cached = _cache.get(key)
+            if cached is None or cached[0] < time.monotonic():
+                future = _pool().submit(_render_sales_chart, series, image_format)
+                cached = _cache[key] = (time.monotonic() + CHART_TTL, future)
+    future = cached[1]
+    try:
+        return future.result()
+    except Exception:
+        with _lock:
+            if _cache.get(key) is cached:
+                del _cache[key]
+        raise
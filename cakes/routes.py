@@ -2,16 +2,11 @@
 import os
 import calendar
 import io
-import math
 import random
 from datetime import datetime, timedelta
 from functools import wraps
 
 # --- Third-party Library Imports ---
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from matplotlib.ticker import MaxNLocator
 try:
     from bson.objectid import ObjectId
 except ImportError:
@@ -40,74 +35,31 @@ from werkzeug.utils import secure_filename
 from itsdangerous import URLSafeTimedSerializer
 
 # --- Local Application Imports ---
-from . import db, mail
+from . import db
 from .models import User
+from .user_cache import user_cache
 from .forms import SignupForm, LoginForm, RequestResetForm, ResetPasswordForm
+from .pagination import keyset_page
+from .search import catalog_query
+from .suggest import suggestions
+from .facets import catalog_facets
+from .catalog_cache import catalog_metadata
+from .outbox import email_outbox
+from .loyalty import get_loyalty_points, reconcile_loyalty
+from .order_events import insert_order, change_order_status, delete_order
+from .order_ids import next_order_id
+from .idempotency import idempotent
+from .order_consumers import order_counters
+from .related import related_cakes_for, refresh_cake as refresh_related, remove_cake as remove_related
 
 # --- Blueprint Configuration ---
 routes_bp = Blueprint('routes', __name__)
 
-def calculate_loyalty_points(customer_email):
-    """Calculate loyalty points based on user activity."""
-    try:
-        # Get or create loyalty points document
-        loyalty_doc = db.loyalty_points.find_one({'customer_email': customer_email})
-        
-        if not loyalty_doc:
-            # Create new loyalty points document
-            loyalty_doc = {
-                'customer_email': customer_email,
-                'points': 0,
-                'total_orders': 0,
-                'total_spent': 0,
-                'last_updated': datetime.now(),
-                'created_at': datetime.now()
-            }
-            db.loyalty_points.insert_one(loyalty_doc)
-        
-        # Calculate points based on orders
-        total_orders = db.orders.count_documents({'customer_email': customer_email})
-        orders = list(db.orders.find({'customer_email': customer_email}))
-        total_spent = sum(order.get('total_amount', 0) for order in orders)
-        
-        # Calculate new points
-        new_points = 0
-        
-        # Points for orders (10 points per order)
-        new_points += total_orders * 10
-        
-        # Points for spending (1 point per 1000 shillings)
-        new_points += int(total_spent / 1000)
-        
-        # Bonus points for milestones
-        if total_orders >= 5:
-            new_points += 50  # 5+ orders bonus
-        if total_orders >= 10:
-            new_points += 100  # 10+ orders bonus
-        if total_spent >= 500000:  # 500k shillings
-            new_points += 200  # Big spender bonus
-        
-        # Update loyalty points
-        db.loyalty_points.update_one(
-            {'customer_email': customer_email},
-            {
-                '$set': {
-                    'points': new_points,
-                    'total_orders': total_orders,
-                    'total_spent': total_spent,
-                    'last_updated': datetime.now()
-                }
-            }
-        )
-        
-        return new_points
-        
-    except Exception as e:
-        print(f"Error calculating loyalty points: {e}")
-        return 0
-
 # --- Constants ---
 CAKES_PER_PAGE = 6
+ADMIN_PAGE_SIZE = 50
+# Stable catalog order for keyset pagination (see pagination.py)
+CATALOG_SORT = [('_id', 1)]
 
 
 # =============================================================================
@@ -130,23 +82,20 @@ def admin_required(f):
     return decorated_function
 
 def _get_users_with_student_status(limit=None):
-    """Fetches users with the 'customer' role and enriches them with an 'is_student' flag."""
-    pipeline = [
-        {'$match': {'role': 'customer'}},
-        {'$sort': {'_id': -1}}
-    ]
+    """
+    Fetches users with the 'customer' role, newest first. The 'is_student' flag
+    is denormalised onto the user document (set by register_class and the
+    backfill-student-flags command), so no join against students is needed.
+    """
+    cursor = db.users.find({'role': 'customer'}).sort('_id', -1)
     if limit:
-        pipeline.append({'$limit': limit})
-    
-    pipeline.extend([
-        {'$lookup': {
-            'from': 'students', 'localField': 'email',
-            'foreignField': 'user_email', 'as': 'student_info'
-        }},
-        {'$addFields': {'is_student': {'$gt': [{'$size': '$student_info'}, 0]}}}
-    ])
+        cursor = cursor.limit(limit)
     
-    return list(db.users.aggregate(pipeline))
+    users = []
+    for user in cursor:
+        user['is_student'] = bool(user.get('is_student', False))
+        users.append(user)
+    return users
 
 
 # =============================================================================
@@ -160,7 +109,7 @@ def home():
     featured_cakes = list(db.cakes.find().sort('_id', -1).limit(6))
     
     # Get statistics for homepage
-    total_cakes = db.cakes.count_documents({})
+    total_cakes = catalog_metadata.get(db)['count']
     total_customers = db.users.count_documents({'role': 'customer'})
     total_orders = db.orders.count_documents({})
     
@@ -207,28 +156,17 @@ def customer():
     selected_category = request.args.get('category')
     search_query = request.args.get('q', '').strip()
     
-    query = {}
-    if selected_category:
-        query['category'] = selected_category
-    
-    if search_query:
-        query['name'] = {'$regex': search_query, '$options': 'i'}
-
-    # Fetch dynamic categories from the database for the dropdown
-    all_categories = db.cakes.distinct("category")
-    all_categories.sort()
-
-    total_cakes = db.cakes.count_documents(query)
-    initial_cakes = list(db.cakes.find(query).limit(CAKES_PER_PAGE))
-    total_pages = math.ceil(total_cakes / CAKES_PER_PAGE)
+    # Categories with counts, price bands and the first page in one aggregation
+    listing = catalog_facets.get(db, selected_category, search_query, CATALOG_SORT, CAKES_PER_PAGE)
     
     return render_template('CustomerPage.html', 
-                           cakes=initial_cakes,
-                           categories=all_categories,
+                           cakes=listing['cakes'],
+                           categories=listing['categories'],
+                           price_bands=listing['price_bands'],
+                           total_cakes=listing['total'],
                            selected_category=selected_category,
                            search_query=search_query,
-                           current_page=1, 
-                           total_pages=total_pages)
+                           next_cursor=listing['next_cursor'])
                            
 @routes_bp.route('/cake/<cake_id>')
 def cake_details(cake_id):
@@ -244,25 +182,8 @@ def cake_details(cake_id):
             flash('Sorry, that cake could not be found.', 'danger')
             return redirect(url_for('routes.customer'))
         
-        # Find related cakes from the same category
-        try:
-            related_cakes = list(db.cakes.find({
-                'category': cake.get('category'), 
-                '_id': {'$ne': ObjectId(cake_id)}
-            }).limit(3))
-        except:
-            related_cakes = list(db.cakes.find({
-                'category': cake.get('category'), 
-                '_id': {'$ne': cake_id}
-            }).limit(3))
-        
-        # If not enough related cakes, fill with other random cakes
-        if len(related_cakes) < 3:
-            try:
-                more_cakes = list(db.cakes.find({'_id': {'$ne': ObjectId(cake_id)}}).limit(3 - len(related_cakes)))
-            except:
-                more_cakes = list(db.cakes.find({'_id': {'$ne': cake_id}}).limit(3 - len(related_cakes)))
-            related_cakes.extend(more_cakes)
+        # Precomputed recommendations (see related.py): one lookup by cake id
+        related_cakes = related_cakes_for(db, cake)
 
         # Get reviews for this specific cake
         cake_reviews = list(db.comments.find({'cake_id': str(cake.get('_id', ''))}).sort('_id', -1).limit(10))
@@ -411,15 +332,13 @@ def signup():
         msg = Message('Your FynCakes Verification Code', recipients=[email])
         msg.body = f'Welcome to FynCakes! Your verification code is: {verification_code}'
         
-        # Try to send email, but redirect to verification page regardless
-        email_sent = False
+        # Queue the email (sent in the background), but redirect to verification page regardless
         try:
-            mail.send(msg)
-            email_sent = True
-            print(f"✅ Verification email sent successfully to {email}")
+            email_outbox.send(msg)
+            print(f"✅ Verification email queued for {email}")
             flash('A verification code has been sent to your email.', 'success')
         except Exception as e:
-            print(f"❌ Failed to send verification email to {email}: {str(e)}")
+            print(f"❌ Failed to queue verification email to {email}: {str(e)}")
             flash(f'Email sending failed, but you can still verify using the code: {verification_code}', 'warning')
         
         # Always redirect to verification page, regardless of email success
@@ -529,7 +448,7 @@ def request_reset():
 
 If you did not make this request, simply ignore this email.
 '''
-            mail.send(msg)
+            email_outbox.send(msg)
         
         flash('If an account with that email exists, a password reset link has been sent.', 'info')
         return redirect(url_for('routes.login'))
@@ -550,6 +469,7 @@ def reset_password(token):
     if form.validate_on_submit():
         hashed_password = generate_password_hash(form.password.data)
         db.users.update_one({'email': user_email}, {'$set': {'password': hashed_password}})
+        user_cache.invalidate(user_email)
         flash('Your password has been updated! You can now log in.', 'success')
         return redirect(url_for('routes.login'))
         
@@ -565,16 +485,14 @@ def reset_password(token):
 def admin_dashboard():
     """Renders the main admin dashboard with site statistics."""
     try:
-        # Basic counts
-        total_orders = db.orders.count_documents({})
+        # Basic counts (order totals come from the event-driven order counters)
+        counters = order_counters()
+        total_orders = counters['total']
         total_customers = db.users.count_documents({'role': 'customer'})
         total_cakes = db.cakes.count_documents({})
         
         # Sales data
-        sales_data = list(db.orders.aggregate([
-            {"$group": {"_id": None, "total_sales": {"$sum": "$total_amount"}}}
-        ]))
-        total_sales = sales_data[0]['total_sales'] if sales_data else 0
+        total_sales = counters['revenue']
         
         # Today's orders (using string comparison since created_at might be stored as string)
         from datetime import datetime, timedelta
@@ -593,7 +511,7 @@ def admin_dashboard():
         weekly_sales = weekly_sales_data[0]['total_sales'] if weekly_sales_data else 0
         
         # Pending orders
-        pending_orders = db.orders.count_documents({'status': 'pending'})
+        pending_orders = counters['by_status'].get('pending', 0)
         
         # New customers (total customers for now, since we might not have creation dates)
         new_customers = db.users.count_documents({'role': 'customer'})
@@ -646,6 +564,23 @@ def admin_dashboard():
                                last_backup="Unknown",
                                uptime="00:00:00")
 
+@routes_bp.route('/admin/reports/sales.<image_format>')
+@admin_required
+def sales_chart_image(image_format):
+    """Serves the daily sales chart for the admin dashboard as PNG or SVG."""
+    from .reports import IMAGE_TYPES, sales_chart
+    if image_format not in IMAGE_TYPES:
+        return "Unsupported image format", 404
+    days = min(max(request.args.get('days', 30, type=int), 1), 365)
+    try:
+        image = sales_chart(db, days, image_format)
+    except Exception as e:
+        print(f"Error rendering sales chart: {e}")
+        return "Chart unavailable", 503
+    response = Response(image, mimetype=IMAGE_TYPES[image_format])
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response
+
 @routes_bp.route('/api/dashboard_stats')
 @admin_required
 def dashboard_stats():
@@ -653,16 +588,14 @@ def dashboard_stats():
     try:
         from datetime import datetime, timedelta
         
-        # Basic counts
-        total_orders = db.orders.count_documents({})
+        # Basic counts (order totals come from the event-driven order counters)
+        counters = order_counters()
+        total_orders = counters['total']
         total_customers = db.users.count_documents({'role': 'customer'})
         total_cakes = db.cakes.count_documents({})
         
         # Sales data
-        sales_data = list(db.orders.aggregate([
-            {"$group": {"_id": None, "total_sales": {"$sum": "$total_amount"}}}
-        ]))
-        total_sales = sales_data[0]['total_sales'] if sales_data else 0
+        total_sales = counters['revenue']
         
         # Today's orders (using string comparison since created_at might be stored as string)
         today = datetime.now().strftime('%Y-%m-%d')
@@ -680,7 +613,7 @@ def dashboard_stats():
         weekly_sales = weekly_sales_data[0]['total_sales'] if weekly_sales_data else 0
         
         # Pending orders
-        pending_orders = db.orders.count_documents({'status': 'pending'})
+        pending_orders = counters['by_status'].get('pending', 0)
         
         # New customers this week
         new_customers = db.users.count_documents({
@@ -718,15 +651,26 @@ def dashboard_stats():
 @routes_bp.route('/admin/manage_orders')
 @admin_required
 def manage_orders():
-    """Renders a page to view all customer orders."""
+    """Renders a page to view all customer orders, newest first."""
+    after = request.args.get('after')
     try:
-        all_orders = list(db.orders.find().sort('_id', -1))
-        for order in all_orders:
+        orders, next_cursor, _ = keyset_page(db.orders, {}, [('_id', -1)], ADMIN_PAGE_SIZE, after)
+        for order in orders:
             order['_id'] = str(order['_id'])
-        return render_template('manage_orders.html', orders=all_orders)
+        # Totals cover every order, not just this page; kept up to date by the order events
+        counters = order_counters()
+        stats = {
+            'total': counters['total'],
+            'pending': counters['by_status'].get('pending', 0),
+            'completed': counters['by_status'].get('completed', 0),
+            'revenue': counters['revenue'],
+        }
+        return render_template('manage_orders.html', orders=orders, stats=stats,
+                               after=after, next_cursor=next_cursor)
     except Exception as e:
         print(f"Error loading orders: {e}")
-        return render_template('manage_orders.html', orders=[])
+        return render_template('manage_orders.html', orders=[],
+                               stats={'total': 0, 'pending': 0, 'completed': 0, 'revenue': 0})
 
 @routes_bp.route('/admin/orders/<order_id>')
 @admin_required
@@ -792,11 +736,15 @@ def order_update(order_id):
             # Remove empty values
             update_data = {k: v for k, v in update_data.items() if v is not None and v != ''}
             
-            # Update the order
-            result = db.orders.update_one(
-                {'_id': ObjectId(order_id)}, 
-                {'$set': update_data}
-            )
+            # Update the order; a status change goes with its order event
+            new_status = update_data.pop('status', None)
+            if new_status is not None and new_status != order.get('status'):
+                result = change_order_status(order, new_status, update_data)
+            else:
+                result = db.orders.update_one(
+                    {'_id': ObjectId(order_id)}, 
+                    {'$set': update_data}
+                )
             
             if result.modified_count > 0:
                 print(f"✅ Order {order_id} updated successfully")
@@ -827,8 +775,8 @@ def order_delete(order_id):
         if not order:
             return jsonify({'success': False, 'message': 'Order not found!'})
         
-        # Delete the order
-        result = db.orders.delete_one({'_id': ObjectId(order_id)})
+        # Delete the order (and log it for the dashboard counters)
+        result = delete_order(order)
         
         if result.deleted_count > 0:
             print(f"✅ Order {order_id} deleted successfully")
@@ -925,6 +873,7 @@ def edit_user(user_id):
                     {'_id': ObjectId(user_id)},
                     {'$set': update_data}
                 )
+                user_cache.invalidate(user.get('email'), update_data['email'])
                 
                 flash('User updated successfully!', 'success')
                 return redirect(url_for('routes.manage_users'))
@@ -944,8 +893,10 @@ def edit_user(user_id):
 def delete_user(user_id):
     """Delete a user from the system."""
     try:
+        user = db.users.find_one({'_id': ObjectId(user_id)})
         result = db.users.delete_one({'_id': ObjectId(user_id)})
         if result.deleted_count > 0:
+            user_cache.invalidate(user.get('email'))
             flash('User deleted successfully!', 'success')
         else:
             flash('User not found!', 'error')
@@ -958,6 +909,21 @@ def delete_user(user_id):
 # API ENDPOINTS FOR FRONTEND INTEGRATION
 # =============================================================================
 
+@routes_bp.route('/health')
+def health():
+    """Health endpoint for load balancers: 503 while MongoDB fails its health checks."""
+    status = db.status()
+    return jsonify({'success': status['healthy'] is not False, **status}), 503 if status['healthy'] is False else 200
+
+@routes_bp.route('/api/email_queue')
+@admin_required
+def email_queue_stats():
+    """API endpoint reporting the outgoing email queue depth."""
+    depth = email_outbox.queue_depth()
+    if depth['oldest_pending_at'] is not None:
+        depth['oldest_pending_at'] = str(depth['oldest_pending_at'])
+    return jsonify({'success': True, **depth})
+
 @routes_bp.route('/api/orders', methods=['GET'])
 @login_required
 def api_get_orders():
@@ -1014,10 +980,13 @@ def api_update_order_status(order_id):
         if new_status not in valid_statuses:
             return jsonify({'success': False, 'message': 'Invalid status'}), 400
         
-        result = db.orders.update_one(
-            {'_id': ObjectId(order_id)},
-            {'$set': {'status': new_status, 'updated_at': datetime.now()}}
-        )
+        order = db.orders.find_one({'_id': ObjectId(order_id)})
+        if not order:
+            return jsonify({'success': False, 'message': 'Order not found'}), 404
+        if order.get('status') == new_status:
+            return jsonify({'success': True, 'message': 'Order status updated'})
+        
+        result = change_order_status(order, new_status, {'updated_at': datetime.now()})
         
         if result.modified_count > 0:
             return jsonify({'success': True, 'message': 'Order status updated'})
@@ -1078,15 +1047,12 @@ def api_get_stats():
     """API endpoint to get user statistics."""
     try:
         if current_user.role == 'admin':
-            # Admin statistics
-            total_orders = db.orders.count_documents({})
+            # Admin statistics (order totals from the same counters as the dashboards)
+            counters = order_counters()
+            total_orders = counters['total']
             total_customers = db.users.count_documents({'role': 'customer'})
             total_cakes = db.cakes.count_documents({})
-            
-            sales_data = list(db.orders.aggregate([
-                {"$group": {"_id": None, "total_sales": {"$sum": "$total_amount"}}}
-            ]))
-            total_sales = sales_data[0]['total_sales'] if sales_data else 0
+            total_sales = counters['revenue']
             
             stats = {
                 'total_orders': total_orders,
@@ -1136,20 +1102,28 @@ def upload():
                 'image': url_for('static', filename=f'cake_uploads/{filename}')
             }
             db.cakes.insert_one(cake_data)
+            suggestions.update_cake(cake_data)
+            catalog_facets.invalidate()
+            catalog_metadata.invalidate()
+            refresh_related(db, cake_data['_id'])
             flash(f"Cake '{cake_data['name']}' uploaded successfully!", 'success')
             return redirect(url_for('routes.manage_cakes'))
 
-    # Fetch categories for the GET request to populate the dropdown
-    all_categories = db.cakes.distinct("category")
-    all_categories.sort()
-    return render_template('uploadPage.html', categories=all_categories)
+    # Categories for the dropdown come from the shared catalog metadata cache
+    return render_template('uploadPage.html', categories=catalog_metadata.get(db)['categories'])
 
 @routes_bp.route('/admin/manage_cakes')
 @admin_required
 def manage_cakes():
     """Renders a page where admins can view, edit, and delete all cakes."""
-    all_cakes = list(db.cakes.find().sort('name', 1))
-    return render_template('manage_cakes.html', cakes=all_cakes)
+    after = request.args.get('after')
+    try:
+        cakes, next_cursor, _ = keyset_page(db.cakes, {}, [('name', 1)], ADMIN_PAGE_SIZE, after)
+    except ValueError:
+        return redirect(url_for('routes.manage_cakes'))
+    return render_template('manage_cakes.html', cakes=cakes,
+                           total_cakes=db.cakes.estimated_document_count(),
+                           after=after, next_cursor=next_cursor)
 
 @routes_bp.route('/admin/edit_cake/<cake_id>', methods=['GET', 'POST'])
 @admin_required
@@ -1180,13 +1154,15 @@ def edit_cake(cake_id):
                 updated_data['image'] = url_for('static', filename=f'cake_uploads/{filename}')
         
         db.cakes.update_one({'_id': ObjectId(cake_id)}, {'$set': updated_data})
+        suggestions.update_cake(db.cakes.find_one({'_id': ObjectId(cake_id)}))
+        catalog_facets.invalidate()
+        catalog_metadata.invalidate()
+        refresh_related(db, cake_id)
         flash(f"'{updated_data['name']}' has been updated successfully!", 'success')
         return redirect(url_for('routes.manage_cakes'))
         
-    # Fetch categories for the GET request to populate the dropdown
-    all_categories = db.cakes.distinct("category")
-    all_categories.sort()
-    return render_template('edit_cake.html', cake=cake, categories=all_categories)
+    # Categories for the dropdown come from the shared catalog metadata cache
+    return render_template('edit_cake.html', cake=cake, categories=catalog_metadata.get(db)['categories'])
 
 @routes_bp.route('/admin/delete_cake/<cake_id>', methods=['POST'])
 @admin_required
@@ -1194,6 +1170,10 @@ def delete_cake(cake_id):
     """Handles deleting a cake."""
     try:
         db.cakes.delete_one({'_id': ObjectId(cake_id)})
+        suggestions.remove_cake(cake_id)
+        catalog_facets.invalidate()
+        catalog_metadata.invalidate()
+        remove_related(db, cake_id)
         flash('Cake deleted successfully!', 'success')
     except Exception as e:
         flash(f'Error deleting cake: {e}', 'danger')
@@ -1206,40 +1186,48 @@ def delete_cake(cake_id):
 
 @routes_bp.route('/api/get_cakes')
 def get_cakes_api():
-    """API endpoint to fetch a 'page' of cakes with dynamic filtering."""
-    try:
-        page = int(request.args.get('page', 1))
-    except (ValueError, TypeError):
-        page = 1
-    
-    skip = (page - 1) * CAKES_PER_PAGE
+    """
+    API endpoint to fetch a 'page' of cakes with dynamic filtering. Pass the
+    previous response's next_cursor as 'after' to get the following page;
+    include_total=1 adds the total match count (only needed on page one).
+    """
+    after = request.args.get('after')
+    include_total = request.args.get('include_total', '').lower() in ('1', 'true', 'yes')
     category = request.args.get('category')
     search_query = request.args.get('q', '').strip()
     
-    query = {}
-    if category: # Removed check against hardcoded list
-        query['category'] = category
-        
-    if search_query:
-        query['name'] = {'$regex': search_query, '$options': 'i'} # Use more flexible search
+    query = catalog_query(category, search_query)
 
-    cakes_cursor = db.cakes.find(query).skip(skip).limit(CAKES_PER_PAGE)
+    try:
+        cakes, next_cursor, total_cakes = keyset_page(
+            db.cakes, query, CATALOG_SORT, CAKES_PER_PAGE, after, include_total
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     cakes_list = []
-    for cake in cakes_cursor:
+    for cake in cakes:
         cake['_id'] = str(cake['_id'])
         cake['url'] = url_for('routes.cake_details', cake_id=cake['_id'])
         cakes_list.append(cake)
     
-    # Get total count for pagination
-    total_cakes = db.cakes.count_documents(query)
-    total_pages = math.ceil(total_cakes / CAKES_PER_PAGE)
-        
-    return jsonify({
+    response = {
         'cakes': cakes_list,
-        'current_page': page,
-        'total_pages': total_pages,
-        'total_cakes': total_cakes,
-        'has_more': page < total_pages
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    }
+    if include_total:
+        response['total_cakes'] = total_cakes
+    return jsonify(response)
+
+@routes_bp.route('/api/suggest')
+def suggest_api():
+    """API endpoint for search-box typeahead: top suggestions for a typed prefix."""
+    prefix = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    matches = suggestions.suggest(db, prefix, limit)
+    return jsonify({
+        'query': prefix,
+        'suggestions': [{'text': text, 'type': kind} for text, kind in matches]
     })
 
 @routes_bp.route('/cart/items', methods=['GET'])
@@ -1252,6 +1240,7 @@ def get_cart_items():
 
 @routes_bp.route('/cart/add', methods=['POST'])
 @login_required
+@idempotent
 def add_to_cart_db():
     """API endpoint to add an item to the user's cart."""
     product_data = request.get_json()
@@ -1266,6 +1255,7 @@ def add_to_cart_db():
 
 @routes_bp.route('/cart/remove/<item_id>', methods=['POST'])
 @login_required
+@idempotent
 def remove_from_cart_db(item_id):
     """API endpoint to remove an item from the user's cart."""
     # Note: This logic seems to use cake_id to delete from carts, might need review
@@ -1281,8 +1271,9 @@ def clear_cart():
 
 @routes_bp.route('/place_order', methods=['POST'])
 @login_required
+@idempotent
 def place_order():
-    """Handles the final order placement and sends a confirmation email."""
+    """Handles the final order placement; the confirmation email is queued by the order events."""
     try:
         data = request.get_json()
         products = data.get('products')
@@ -1293,8 +1284,8 @@ def place_order():
         if not all([products, total_amount, delivery_date_str, phone_number]):
             return jsonify({'success': False, 'message': 'Missing order information.'}), 400
 
-        # Generate order ID
-        order_id = f"FYN-{random.randint(1000, 9999)}"
+        # Allocate a unique, increasing order ID
+        order_id = next_order_id()
         
         # Create order document with consistent structure
         from datetime import datetime
@@ -1315,65 +1306,14 @@ def place_order():
             'customer_hidden': False  # For customer history management
         }
         
-        # Insert order into database
-        result = db.orders.insert_one(order_doc)
+        # One write: the order and its 'order_created' event. The confirmation
+        # email, loyalty points and dashboard counters follow in the
+        # background (see order_consumers.py)
+        result = insert_order(order_doc)
         
         if result.inserted_id:
             print(f"✅ Order {order_id} created successfully for {current_user.email}")
             
-            # Send confirmation email
-            try:
-                product_list_html = "".join([f"<li>{p['name']} - Shs {p['price']:,.0f}</li>" for p in products])
-                msg = Message(f"FynCakes Order Confirmation - #{order_id}", recipients=[current_user.email])
-                msg.html = f"""
-                <div style="font-family: sans-serif; max-width: 600px; margin: 0 auto; padding: 20px;">
-                    <div style="text-align: center; margin-bottom: 30px;">
-                        <h1 style="color: #e74c3c;">Thank You for Your Order!</h1>
-                        <p style="font-size: 18px; color: #666;">Your order has been received and is being processed.</p>
-                    </div>
-                    
-                    <div style="background: #f8f9fa; padding: 20px; border-radius: 10px; margin-bottom: 20px;">
-                        <h3 style="color: #2c3e50; margin-top: 0;">Order Details</h3>
-                        <p><strong>Order ID:</strong> #{order_id}</p>
-                        <p><strong>Delivery Date:</strong> {delivery_date_str}</p>
-                        <p><strong>Contact Phone:</strong> {phone_number}</p>
-                    </div>
-                    
-                    <div style="margin-bottom: 20px;">
-                        <h3 style="color: #2c3e50;">Order Summary</h3>
-                        <ul style="list-style: none; padding: 0;">
-                            {product_list_html}
-                        </ul>
-                        <div style="border-top: 2px solid #e74c3c; padding-top: 15px; margin-top: 15px;">
-                            <p style="font-size: 20px; font-weight: bold; color: #e74c3c; margin: 0;">
-                                Total Amount: Shs {total_amount:,.0f}
-                            </p>
-                        </div>
-                    </div>
-                    
-                    <div style="background: #e8f5e8; padding: 20px; border-radius: 10px; border-left: 5px solid #28a745;">
-                        <h3 style="color: #155724; margin-top: 0;">Next Steps: Payment</h3>
-                        <p style="color: #155724; margin-bottom: 10px;">
-                            Please send the total amount via Mobile Money to: 
-                            <strong style="font-size: 18px;">0758 449 390</strong>
-                        </p>
-                        <p style="color: #155724; margin: 0;">
-                            Use your Order ID <strong>({order_id})</strong> as the payment reference.
-                        </p>
-                    </div>
-                    
-                    <div style="text-align: center; margin-top: 30px; padding-top: 20px; border-top: 1px solid #ddd;">
-                        <p style="color: #666; margin: 0;">Thank you for choosing FynCakes!</p>
-                        <p style="color: #666; margin: 5px 0 0 0;">We'll notify you once your payment is confirmed.</p>
-                    </div>
-                </div>
-                """
-                mail.send(msg)
-                print(f"✅ Order confirmation email sent to {current_user.email}")
-            except Exception as e:
-                print(f"❌ Failed to send order confirmation email for {order_id}: {e}")
-                # Don't fail the order if email fails
-            
             return jsonify({
                 'success': True, 
                 'message': f"Order #{order_id} placed successfully! Please check your email for payment instructions.",
@@ -1410,6 +1350,9 @@ def register_class():
         'payment_status': 'pending_deposit',
         'has_access': False
     })
+    # Keep the denormalised flag on the user in step with the students collection
+    db.users.update_one({'email': current_user.email}, {'$set': {'is_student': True}})
+    user_cache.invalidate(current_user.email)
 
     try:
         msg = Message("Welcome to FynCakes Baking Class!", recipients=[current_user.email])
@@ -1419,9 +1362,9 @@ def register_class():
             <p>To complete your registration, please send a 50% deposit of <strong>Shs 150,000</strong> via Mobile Money to <strong>0758 449 390</strong>.</p>
         </div>
         """
-        mail.send(msg)
+        email_outbox.send(msg)
     except Exception as e:
-        current_app.logger.error(f"Failed to send class registration email for {current_user.email}: {e}")
+        current_app.logger.error(f"Failed to queue class registration email for {current_user.email}: {e}")
 
     return jsonify({'success': True, 'message': 'Your spot is reserved! Please check your email for payment instructions.'})
 
@@ -1439,6 +1382,10 @@ def update_cake_api(cake_id):
         )
         
         if result.modified_count > 0:
+            suggestions.update_cake(db.cakes.find_one({'_id': cake_id}))
+            catalog_facets.invalidate()
+            catalog_metadata.invalidate()
+            refresh_related(db, cake_id)
             return jsonify({'success': True, 'message': 'Cake updated successfully'})
         else:
             return jsonify({'success': False, 'message': 'Cake not found or no changes made'}), 404
@@ -1545,23 +1492,24 @@ def customer_dashboard():
                             })
                             wishlist_items.append(wishlist_item)
         
-        # Calculate and update loyalty points
-        loyalty_points = calculate_loyalty_points(current_user.email)
+        # Loyalty points are kept up to date by the order events
+        loyalty_points = get_loyalty_points(current_user.email)
         
         # Add some sample data for demonstration if user has no orders
         if total_orders == 0:
-            # Add a sample order for demonstration
+            # Add a sample order for demonstration. It is written directly,
+            # without an order event: no confirmation email, loyalty points
+            # or dashboard counts for a demo order
             sample_order = {
                 'customer_email': current_user.email,
                 'customer_name': current_user.first_name or current_user.username,
                 'items': [{'name': 'Welcome Cake', 'price': 50000, 'quantity': 1}],
                 'total_amount': 50000,
                 'status': 'completed',
-                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'sample': True
             }
             db.orders.insert_one(sample_order)
-            # Recalculate loyalty points
-            loyalty_points = calculate_loyalty_points(current_user.email)
         
         return render_template('customer_dashboard.html', 
                              orders=customer_orders,
@@ -1597,7 +1545,9 @@ def customer_profile():
                 'city': request.form.get('city'),
                 'district': request.form.get('district'),
                 'postal_code': request.form.get('postal_code'),
-                'is_student': request.form.get('is_student') == 'true',
+                # Self-declared; is_student itself is only set by class
+                # registration and admins
+                'student_discount_requested': request.form.get('student_discount_requested') == 'true',
                 'newsletter': request.form.get('newsletter') == 'true'
             }
             
@@ -1611,7 +1561,9 @@ def customer_profile():
                     flash('New passwords do not match!', 'error')
                     return render_template('customer_profile.html')
                 
-                if not check_password_hash(current_user.password, current_password):
+                # The cached User doesn't carry the password hash
+                user_data = db.users.find_one({'email': current_user.email})
+                if not user_data or not check_password_hash(user_data['password'], current_password):
                     flash('Current password is incorrect!', 'error')
                     return render_template('customer_profile.html')
                 
@@ -1622,6 +1574,7 @@ def customer_profile():
                 {'_id': current_user._id},
                 {'$set': update_data}
             )
+            user_cache.invalidate(current_user.email, update_data['email'])
             
             flash('Profile updated successfully!', 'success')
             return redirect(url_for('routes.customer_profile'))
@@ -1633,6 +1586,7 @@ def customer_profile():
 
 @routes_bp.route('/wishlist/add', methods=['POST'])
 @login_required
+@idempotent
 def add_to_wishlist():
     """Add a cake to the user's wishlist."""
     try:
@@ -1669,6 +1623,7 @@ def add_to_wishlist():
 
 @routes_bp.route('/wishlist/remove', methods=['POST'])
 @login_required
+@idempotent
 def remove_from_wishlist():
     """Remove a cake from the user's wishlist."""
     try:
@@ -1856,18 +1811,12 @@ def customer_cancel_order(order_id):
             return jsonify({'success': False, 'message': 'Only pending orders can be cancelled!'})
         
         # Update order status to cancelled and add customer_hidden flag
-        result = db.orders.update_one(
-            {'_id': ObjectId(order_id)},
-            {
-                '$set': {
-                    'status': 'cancelled',
-                    'customer_hidden': False,  # Keep visible to customer initially
-                    'cancelled_by': 'customer',
-                    'cancelled_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                }
-            }
-        )
+        result = change_order_status(order, 'cancelled', {
+            'customer_hidden': False,  # Keep visible to customer initially
+            'cancelled_by': 'customer',
+            'cancelled_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        })
         
         if result.modified_count > 0:
             print(f"✅ Order {order_id} cancelled by customer {current_user.email}")
@@ -2018,7 +1967,7 @@ def customer_clear_history():
 def refresh_loyalty_points():
     """Refresh loyalty points for the current user."""
     try:
-        new_points = calculate_loyalty_points(current_user.email)
+        new_points = reconcile_loyalty(current_user.email)
         flash(f'Loyalty points refreshed! You now have {new_points} points.', 'success')
         return redirect(url_for('routes.customer_dashboard'))
     except Exception as e:
@@ -0,0 +1,15 @@
+# cakes/search.py
+# Catalog search over the cakes text index (name, description, category and
+# ingredients; see indexes.py), ranked by relevance.
+
+TEXT_SCORE = {'$meta': 'textScore'}
+
+
+def catalog_query(category=None, search_query=''):
+    """Builds the cakes filter for the catalog's category dropdown and search box."""
+    query = {}
+    if category:
+        query['category'] = category
+    if search_query:
+        query['$text'] = {'$search': search_query}
+    return query
@@ -0,0 +1,139 @@
+# cakes/suggest.py
+# In-memory typeahead index for the catalog search box (/api/suggest).
+# Cake names, categories and ingredients are kept in a sorted array searched
+# with bisect, and updated incrementally when the admin views change a cake.
+
+import bisect
+import re
+import threading
+import time
+
+# Suggestion kinds, in the order they are ranked
+KIND_RANK = {'cake': 0, 'category': 1, 'ingredient': 2}
+
+_WORD_START = re.compile(r'(?:^|(?<=[^\w]))\w', re.UNICODE)
+
+
+def _normalise(text):
+    return ' '.join(text.lower().split())
+
+
+class SuggestionIndex:
+    """
+    Prefix index over the catalog. Every suggestion is stored once per word
+    it contains (under the text from that word on), so typing 'delig' finds
+    'Chocolate Delight'. A lookup bisects to the first key with the typed
+    prefix and walks forward, which is a few microseconds for a catalog.
+
+    Each worker process keeps its own copy: changes made through this worker
+    are applied immediately, and the whole index is rebuilt from the database
+    once it is older than ``max_age`` seconds to pick up changes made
+    elsewhere.
+    """
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._keys = []        # sorted (key, display text, kind)
+        self._counts = {}      # (display text, kind) -> number of cakes using it
+        self._by_cake = {}     # cake id -> set of (display text, kind)
+
+    # --- Building ------------------------------------------------------------
+
+    @staticmethod
+    def _entries_for(cake):
+        entries = set()
+        if cake.get('name'):
+            entries.add((cake['name'].strip(), 'cake'))
+        if cake.get('category'):
+            entries.add((cake['category'].strip(), 'category'))
+        for ingredient in cake.get('ingredients') or []:
+            if isinstance(ingredient, str) and ingredient.strip():
+                entries.add((ingredient.strip(), 'ingredient'))
+        return entries
+
+    @staticmethod
+    def _keys_for(text, kind):
+        normalised = _normalise(text)
+        return [(normalised[match.start():], text, kind) for match in _WORD_START.finditer(normalised)]
+
+    def _add_entry(self, entry):
+        count = self._counts.get(entry, 0)
+        self._counts[entry] = count + 1
+        if count == 0:
+            for key in self._keys_for(*entry):
+                bisect.insort(self._keys, key)
+
+    def _remove_entry(self, entry):
+        count = self._counts.get(entry, 0)
+        if count <= 1:
+            self._counts.pop(entry, None)
+            for key in self._keys_for(*entry):
+                position = bisect.bisect_left(self._keys, key)
+                if position < len(self._keys) and self._keys[position] == key:
+                    del self._keys[position]
+        else:
+            self._counts[entry] = count - 1
+
+    def rebuild(self, db):
+        """Reloads every suggestion from the cakes collection."""
+        by_cake = {}
+        counts = {}
+        for cake in db.cakes.find({}):
+            entries = self._entries_for(cake)
+            by_cake[str(cake['_id'])] = entries
+            for entry in entries:
+                counts[entry] = counts.get(entry, 0) + 1
+        keys = sorted(key for entry in counts for key in self._keys_for(*entry))
+        with self._lock:
+            self._by_cake, self._counts, self._keys = by_cake, counts, keys
+            self._loaded_at = time.monotonic()
+
+    def update_cake(self, cake):
+        """Adds or refreshes one cake's suggestions (call after inserting or editing it)."""
+        if cake is None:
+            return
+        cake_id = str(cake['_id'])
+        entries = self._entries_for(cake)
+        with self._lock:
+            if self._loaded_at is None:
+                return  # Not built yet; the first lookup loads everything
+            previous = self._by_cake.get(cake_id, set())
+            for entry in previous - entries:
+                self._remove_entry(entry)
+            for entry in entries - previous:
+                self._add_entry(entry)
+            self._by_cake[cake_id] = entries
+
+    def remove_cake(self, cake_id):
+        """Drops one cake's suggestions (call after deleting it)."""
+        with self._lock:
+            for entry in self._by_cake.pop(str(cake_id), set()):
+                self._remove_entry(entry)
+
+    # --- Lookup --------------------------------------------------------------
+
+    def suggest(self, db, prefix, limit=8):
+        """Returns up to ``limit`` (text, kind) suggestions for a typed prefix."""
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age:
+            self.rebuild(db)
+        prefix = _normalise(prefix)
+        if not prefix:
+            return []
+        matches = {}
+        with self._lock:
+            keys = self._keys
+            position = bisect.bisect_left(keys, (prefix,))
+            while position < len(keys) and keys[position][0].startswith(prefix):
+                key, text, kind = keys[position]
+                # Prefer suggestions that start with the prefix over mid-text matches
+                starts = key == _normalise(text)
+                rank = (KIND_RANK[kind], not starts, -self._counts.get((text, kind), 0), len(text), text)
+                if (text, kind) not in matches or rank < matches[(text, kind)]:
+                    matches[(text, kind)] = rank
+                position += 1
+        ranked = sorted(matches, key=matches.get)
+        return ranked[:limit]
+
+
+suggestions = SuggestionIndex()
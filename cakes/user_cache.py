@@ -0,0 +1,56 @@
+# cakes/user_cache.py
+# Short-lived cache of User objects for the Flask-Login user_loader, so an
+# authenticated page view doesn't re-read the user document every time.
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """
+    Size-bounded LRU cache of email -> User with a short TTL. Each process
+    (gunicorn worker) has its own cache; routes that change a user call
+    invalidate() so this worker sees the change at once, and the TTL bounds
+    how long other workers can serve the old version.
+    """
+    def __init__(self, ttl=30, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email):
+        with self._lock:
+            entry = self._entries.get(email)
+            if entry is None:
+                return None
+            user, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[email]
+                return None
+            self._entries.move_to_end(email)
+            return user
+
+    def put(self, user):
+        with self._lock:
+            self._entries[user.email] = (user, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user.email)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *emails):
+        with self._lock:
+            for email in emails:
+                self._entries.pop(email, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache(
+    ttl=float(os.environ.get('USER_CACHE_TTL', 30)),
+    max_size=int(os.environ.get('USER_CACHE_SIZE', 1024)),
+)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Test that the mock database matches queries the way MongoDB does
+"""
+
+from cakes.mock_db import MockDatabase, compile_query
+
+
+def test_array_element_matching():
+    """Scalar equality, $in and friends match the elements of array fields"""
+    cake = {'name': 'Carrot Cake', 'tags': ['vegan', 'nut-free'], 'sizes': [6, 8, 10]}
+
+    assert compile_query({'tags': 'vegan'})(cake)
+    assert compile_query({'tags': {'$eq': 'nut-free'}})(cake)
+    assert compile_query({'tags': {'$in': ['gluten-free', 'vegan']}})(cake)
+    assert compile_query({'sizes': {'$gt': 9}})(cake)
+    assert compile_query({'tags': {'$regex': '^veg'}})(cake)
+    # The whole array still matches as a value
+    assert compile_query({'tags': ['vegan', 'nut-free']})(cake)
+
+    assert not compile_query({'tags': 'gluten-free'})(cake)
+    assert not compile_query({'tags': {'$in': ['gluten-free']}})(cake)
+    assert not compile_query({'tags': {'$ne': 'vegan'}})(cake)
+    assert not compile_query({'tags': {'$nin': ['vegan']}})(cake)
+    assert compile_query({'tags': {'$nin': ['gluten-free']}})(cake)
+    assert not compile_query({'sizes': {'$gt': 10}})(cake)
+
+
+def test_array_element_matching_through_an_index():
+    """An index on an array field finds documents by any of their elements"""
+    db = MockDatabase()
+    db.cakes.create_index([('tags', 1)])
+    db.cakes.insert_one({'_id': 1, 'tags': ['vegan', 'nut-free']})
+    db.cakes.insert_one({'_id': 2, 'tags': ['vegan']})
+    db.cakes.insert_one({'_id': 3, 'tags': 'nut-free'})
+
+    assert sorted(cake['_id'] for cake in db.cakes.find({'tags': 'vegan'})) == [1, 2]
+    assert sorted(cake['_id'] for cake in db.cakes.find({'tags': {'$in': ['nut-free']}})) == [1, 3]
+    assert [cake['_id'] for cake in db.cakes.find({'tags': ['vegan']})] == [2]
+    assert sorted(cake['_id'] for cake in db.cakes.find({'tags': {'$gte': 'a'}})) == [1, 2, 3]
+
+    db.cakes.update_one({'_id': 2}, {'$set': {'tags': ['gluten-free']}})
+    assert [cake['_id'] for cake in db.cakes.find({'tags': 'vegan'})] == [1]
+    assert [cake['_id'] for cake in db.cakes.find({'tags': 'gluten-free'})] == [2]
+    db.cakes.delete_one({'_id': 1})
+    assert list(db.cakes.find({'tags': 'vegan'})) == []
+
+
+if __name__ == "__main__":
+    test_array_element_matching()
+    test_array_element_matching_through_an_index()
+    print("✅ Mock database matches array fields like MongoDB")
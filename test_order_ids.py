@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Test that legacy duplicate order IDs can be renumbered so the unique index builds
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from cakes import order_ids
+from cakes.indexes import ensure_indexes
+from cakes.mock_db import DuplicateKeyError, MockDatabase
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = MockDatabase()
+    monkeypatch.setattr(order_ids, 'db', database)
+    monkeypatch.setattr(order_ids, 'order_numbers',
+                        order_ids.BlockAllocator('order_id', start=order_ids.FIRST_ORDER_NUMBER))
+    return database
+
+
+def test_unique_index_over_legacy_duplicates(db):
+    """The unique order_id index builds once duplicate legacy IDs are renumbered"""
+    start = datetime(2024, 1, 1)
+    for number, order_id in enumerate(['FYN-1234', 'FYN-5678', 'FYN-1234', 'FYN-1234']):
+        db.orders.insert_one({'_id': f"order_{number}", 'order_id': order_id,
+                              'created_at': start + timedelta(days=number)})
+    db.orders.insert_one({'_id': 'sample', 'sample': True})
+
+    with pytest.raises(DuplicateKeyError):
+        db.orders.create_index([('order_id', 1)], unique=True, sparse=True)
+
+    renumbered = order_ids.renumber_duplicate_order_ids()
+    assert renumbered == [('FYN-1234', 'FYN-1000001'), ('FYN-1234', 'FYN-1000002')]
+    # The oldest order keeps its ID
+    assert db.orders.find_one({'_id': 'order_0'})['order_id'] == 'FYN-1234'
+    assert db.orders.find_one({'_id': 'order_2'})['legacy_order_id'] == 'FYN-1234'
+
+    statuses = {(collection, name): status for collection, name, status in ensure_indexes(db)}
+    assert statuses[('orders', 'order_id_1')] == 'created'
+    assert order_ids.renumber_duplicate_order_ids() == []
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, '-q'])